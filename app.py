@@ -1,60 +1,171 @@
 # app.py
 import os
+import atexit
+import base64
+import csv
+import gzip
 import sqlite3
 import json
+import queue
 import re
-import difflib
-from functools import wraps
-from io import BytesIO
-
-from flask import Flask, render_template, request, redirect, url_for, session, jsonify, send_from_directory
+import hashlib
+import threading
+import time
+import uuid
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache, wraps
+from io import BytesIO, StringIO
+
+import click
+
+from flask import Flask, Response, g, has_request_context, make_response, render_template, request, redirect, url_for, session, jsonify, send_from_directory, stream_with_context
 from werkzeug.security import generate_password_hash, check_password_hash
-from PIL import Image, ImageOps, ImageFilter
-import pytesseract
+from werkzeug.utils import safe_join
+# PIL and pytesseract are imported where first used: most
+# processes (CLI commands, barcode-only workers) never need them.
+
+def _trie_to_regex(node):
+    # Emit a regex for a character trie so shared prefixes are only tried once
+    branches = [re.escape(ch) + _trie_to_regex(child) for ch, child in sorted(node.items()) if ch != ""]
+    if not branches:
+        return ""
+    body = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+    if "" in node:
+        body = "(?:" + body + ")?" if len(branches) == 1 else body + "?"
+    return body
+
+def compile_phrase_matcher(phrases):
+    """
+    Compile phrases into a single-pass substring matcher.
+    Returns a function that takes lower-cased text and returns the set of
+    phrases found in it, i.e. the same answer as `phrase in text` per phrase.
+    """
+    phrases = sorted({p for p in phrases if p})
+    if not phrases:
+        return lambda text: set()
+
+    trie = {}
+    for p in phrases:
+        node = trie
+        for ch in p:
+            node = node.setdefault(ch, {})
+        node[""] = p
+
+    # The lookahead reports the longest phrase starting at every offset.
+    pattern = re.compile("(?=(" + _trie_to_regex(trie) + "))")
+
+    # Any shorter phrase inside a reported one is also present in the text,
+    # so precompute for every phrase the phrases it contains.
+    contained = {}
+    for p in sorted(phrases, key=len):
+        found = {p}
+        node = trie
+        for ch in p[:-1]:
+            node = node[ch]
+            if "" in node:
+                found |= contained[node[""]]
+        for m in pattern.findall(p, 1):
+            found |= contained[m]
+        contained[p] = frozenset(found)
+
+    def match(text):
+        found = set()
+        for m in set(pattern.findall(text)):
+            found |= contained[m]
+        return found
+
+    return match
+
+class Detections(list):
+    """
+    Detection dicts for one text. `complete` is False when the fuzzy pass ran
+    out of FUZZY_BUDGET_MS: such results are not stamped with RULESET_VERSION,
+    so `flask reevaluate-history` looks at them again.
+    """
+    def __init__(self, items=(), complete=True):
+        super().__init__(items)
+        self.complete = complete
 
 def detect_allergens_from_text(raw_text):
     """
-    Scan OCR text and detect allergens.
+    Scan OCR text and detect allergens (returns Detections).
     Adds severity levels: high, medium, low
     """
-    raw_lower = raw_text.lower()
-    detected = []
+    return detect_allergens_with_masks(raw_text)[0]
 
-    for allergen_key, keywords in PREDEFINED_ALLERGENS.items():
-        for kw in keywords:
-            if kw in raw_lower:
-                severity = "high"
-                detected.append({"allergen": allergen_key, "matched": kw, "severity": severity})
-                break  # stop after first match for this allergen
+def detect_allergens_with_masks(raw_text):
+    """
+    detect_allergens_from_text plus the result as {"high", "medium", "low"}
+    allergen bitmasks (see ALLERGEN_BITS), built while detecting.
+    """
+    matcher = ALLERGEN_MATCHER
+    allergen_keys = matcher["allergen_keys"]
+    found = matcher["match"](raw_text.lower())
+
+    # High risk: first keyword (in table order) found for each allergen
+    first_hit = {}
+    for kw in found.intersection(matcher["keywords"]):
+        for a_idx, k_idx in matcher["keywords"][kw]:
+            if a_idx not in first_hit or k_idx < first_hit[a_idx][0]:
+                first_hit[a_idx] = (k_idx, kw)
+    fuzzy_hits, complete = detect_fuzzy_allergens(raw_text, skip=first_hit) if FUZZY_MATCHING else ({}, True)
+    detected = Detections(complete=complete)
+    masks = {"high": 0, "medium": 0, "low": 0}
+    for a_idx in sorted(set(first_hit) | set(fuzzy_hits)):
+        masks["high"] |= 1 << a_idx
+        if a_idx in first_hit:
+            detected.append({"allergen": allergen_keys[a_idx], "matched": first_hit[a_idx][1], "severity": "high",
+                             "confidence": 1.0})
+        else:
+            kw, seen_as, confidence = fuzzy_hits[a_idx]
+            detected.append({"allergen": allergen_keys[a_idx], "matched": kw, "severity": "high",
+                             "confidence": confidence, "ocr_text": seen_as})
 
     # Medium risk: "may contain" or "produced in facility"
-    if "may contain" in raw_lower or "produced in a facility" in raw_lower:
-        for allergen_key in PREDEFINED_ALLERGENS.keys():
-            detected.append({"allergen": allergen_key, "matched": "may contain/produced in facility", "severity": "medium"})
+    if not found.isdisjoint(PRECAUTIONARY_PHRASES):
+        masks["medium"] = ALL_ALLERGENS_MASK
+        for allergen_key in allergen_keys:
+            detected.append({"allergen": allergen_key, "matched": "may contain/produced in facility", "severity": "medium",
+                             "confidence": 1.0})
 
     # Low risk: "free from"
-    if "free from" in raw_lower or "-free" in raw_lower:
+    if not found.isdisjoint(FREE_FROM_MARKERS):
         # Example: "gluten-free"
-        for allergen_key in PREDEFINED_ALLERGENS.keys():
-            for kw in PREDEFINED_ALLERGENS[allergen_key]:
-                if f"{kw} free" in raw_lower or f"{kw}-free" in raw_lower:
-                    detected.append({"allergen": allergen_key, "matched": f"{kw}-free", "severity": "low"})
+        free_hits = set()
+        for phrase in found.intersection(matcher["free_forms"]):
+            free_hits.update(matcher["free_forms"][phrase])
+        for a_idx, k_idx in sorted(free_hits):
+            masks["low"] |= 1 << a_idx
+            kw = matcher["keyword_table"][a_idx][k_idx]
+            detected.append({"allergen": allergen_keys[a_idx], "matched": f"{kw}-free", "severity": "low",
+                             "confidence": 1.0})
 
-    return detected
+    return detected, masks
 
 
 
-# If tesseract binary not in PATH, uncomment and set the path:
-# pytesseract.pytesseract.tesseract_cmd = r'C:\Program Files\Tesseract-OCR\tesseract.exe'
+# If tesseract binary not in PATH, set TESSERACT_CMD, e.g.
+# r'C:\Program Files\Tesseract-OCR\tesseract.exe'
+TESSERACT_CMD = os.environ.get('TESSERACT_CMD', '')
 
 APP_DIR = os.path.dirname(os.path.abspath(__file__))
-DB_PATH = os.path.join(APP_DIR, 'allergy_app.db')
+DB_PATH = os.environ.get('ALLERGY_DB_PATH', os.path.join(APP_DIR, 'allergy_app.db'))
+# postgres://... selects the PostgreSQL backend; anything else uses SQLite at DB_PATH
+DATABASE_URL = os.environ.get('DATABASE_URL', '')
+DB_BUSY_TIMEOUT = float(os.environ.get('DB_BUSY_TIMEOUT', '5'))
+DB_STATEMENT_CACHE = int(os.environ.get('DB_STATEMENT_CACHE', '256'))
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', '8'))
 
 app = Flask(__name__, static_folder='static', template_folder='templates')
 # Make helper functions available inside all templates
 @app.context_processor
 def inject_helpers():
-    return dict(get_user_by_id=get_user_by_id)
+    return dict(get_user_by_id=get_user_by_id, asset_url=asset_url)
 app.secret_key = os.environ.get('SECRET_KEY', 'replace-this-with-a-secure-secret')
 
 # Predefined allergen keywords -> synonyms/keywords used for matching OCR text
@@ -74,6 +185,202 @@ PREDEFINED_ALLERGENS = {
     "lupin": ["lupin", "lupine"]
 }
 
+# Label phrases that turn every allergen into a medium / low risk hit
+PRECAUTIONARY_PHRASES = ("may contain", "produced in a facility")
+FREE_FROM_MARKERS = ("free from", "-free")
+
+def build_allergen_matcher(allergens):
+    """
+    Precompute everything detect_allergens_from_text needs for a keyword table:
+    one compiled matcher over all keywords, "-free" forms and label phrases,
+    plus lookups from a matched phrase back to (allergen index, keyword index).
+    """
+    keywords = {}
+    free_forms = {}
+    for a_idx, kws in enumerate(allergens.values()):
+        for k_idx, kw in enumerate(kws):
+            keywords.setdefault(kw, []).append((a_idx, k_idx))
+            for phrase in (f"{kw} free", f"{kw}-free"):
+                free_forms.setdefault(phrase, []).append((a_idx, k_idx))
+    phrases = list(keywords) + list(free_forms) + list(PRECAUTIONARY_PHRASES) + list(FREE_FROM_MARKERS)
+    return {
+        "match": compile_phrase_matcher(phrases),
+        "keywords": keywords,
+        "free_forms": free_forms,
+        "allergen_keys": list(allergens),
+        "keyword_table": [list(kws) for kws in allergens.values()],
+    }
+
+ALLERGEN_MATCHER = build_allergen_matcher(PREDEFINED_ALLERGENS)
+
+# Allergen sets as integers: bit i is the i-th key of PREDEFINED_ALLERGENS.
+# users.allergy_mask is stored with this layout, so only ever append allergens.
+ALLERGEN_BITS = {key: 1 << i for i, key in enumerate(PREDEFINED_ALLERGENS)}
+ALL_ALLERGENS_MASK = (1 << len(ALLERGEN_BITS)) - 1
+
+def allergen_mask(keys):
+    # Unknown keys (free-text profile entries) have no bit and are ignored
+    mask = 0
+    for key in keys:
+        mask |= ALLERGEN_BITS.get(key, 0)
+    return mask
+
+def mask_to_allergens(mask):
+    return [key for key, bit in ALLERGEN_BITS.items() if mask & bit]
+
+# ---------------- fuzzy (OCR-tolerant) matching ----------------
+# Catches keywords the exact matcher misses because of OCR noise ("rnilk",
+# "pe4nut", "wh eat"). Keywords are indexed by character bigram; a token is
+# only compared (bounded, OCR-plausible edit distance) against keywords sharing enough bigrams
+# to be within the allowed distance. Keywords shorter than 4 letters ("egg",
+# "soy", "cod") are exact-only, 4-letter ones only accept OCR repairs, and the
+# whole pass stops once FUZZY_BUDGET_MS of CPU has been spent on one scan.
+FUZZY_MATCHING = os.environ.get('FUZZY_MATCHING', '1') == '1'
+FUZZY_BUDGET_MS = float(os.environ.get('FUZZY_BUDGET_MS', '5'))
+FUZZY_MIN_CONFIDENCE = float(os.environ.get('FUZZY_MIN_CONFIDENCE', '0.75'))
+FUZZY_REPAIR_PENALTY = 0.5  # an OCR repair (confusable glyph, split word) costs half an edit
+
+_FUZZY_TOKEN_RE = re.compile(r"[a-z0-9|]+")
+_OCR_DIGIT_FIXES = str.maketrans({"0": "o", "1": "l", "|": "l", "3": "e", "4": "a", "5": "s", "8": "b"})
+_OCR_GLYPH_FIXES = (("rn", "m"), ("vv", "w"))
+# Edits left after the repairs above must be ones OCR actually makes: a
+# lookalike letter swap or a thin glyph dropped/added. "sulfate" -> sulfite
+# (a/i) or "cheat" -> wheat (c/w) is a different word, not noise.
+_OCR_LOOKALIKES = frozenset(frozenset(pair) for pair in
+                            ("ce", "co", "eo", "il", "it", "lt", "ij", "ft", "fr", "hb", "hn", "nu", "uv", "gq", "mn"))
+_OCR_THIN_GLYPHS = frozenset("iljtfr")
+# real label words that are still one plausible OCR edit from a keyword
+FUZZY_IGNORE_WORDS = frozenset({
+    "custard", "spent", "wheal", "muster", "spell", "smelt", "cheat", "lactase",
+    "sulfate", "sulphate",
+})
+
+def _fuzzy_max_distance(length):
+    if length < 5:
+        return 0
+    return 1 if length < 9 else 2
+
+def _ocr_edit_distance(a, b, limit):
+    """
+    Edit distance between a and b counting only OCR-plausible edits (see
+    _OCR_LOOKALIKES), or limit + 1 once it must exceed limit.
+    """
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    far = limit + 1
+    previous = [0]
+    for cb in b:
+        previous.append(previous[-1] + 1 if cb in _OCR_THIN_GLYPHS else far)
+    for ca in a:
+        drop = 1 if ca in _OCR_THIN_GLYPHS else far
+        current = [min(previous[0] + drop, far)]
+        for j, cb in enumerate(b, 1):
+            if ca == cb:
+                swap = previous[j - 1]
+            else:
+                swap = previous[j - 1] + (1 if frozenset((ca, cb)) in _OCR_LOOKALIKES else far)
+            add = 1 if cb in _OCR_THIN_GLYPHS else far
+            current.append(min(previous[j] + drop, current[j - 1] + add, swap, far))
+        if min(current) > limit:
+            return far
+        previous = current
+    return previous[-1]
+
+def _bigrams(word):
+    padded = f"^{word}$"
+    return {padded[i:i + 2] for i in range(len(padded) - 1)}
+
+def build_fuzzy_index(allergens):
+    """
+    Index single-word keywords (multi-word ones with spaces removed) of 4+
+    letters by bigram. Entries are (form, allergen index, keyword).
+    """
+    entries = []
+    by_bigram = {}
+    for a_idx, kws in enumerate(allergens.values()):
+        for kw in kws:
+            form = re.sub(r"[^a-z]", "", kw)
+            if len(form) < 4:
+                continue
+            e_idx = len(entries)
+            entries.append((form, a_idx, kw, _bigrams(form)))
+            for gram in entries[-1][3]:
+                by_bigram.setdefault(gram, []).append(e_idx)
+    return {"entries": entries, "by_bigram": by_bigram,
+            "exact": {e[0] for e in entries},
+            "min_len": min((len(e[0]) for e in entries), default=0),
+            "max_len": max((len(e[0]) for e in entries), default=0)}
+
+FUZZY_INDEX = build_fuzzy_index(PREDEFINED_ALLERGENS)
+
+def _fuzzy_lookup(candidate, repaired):
+    """Best (allergen index, keyword, confidence) per allergen for one candidate string."""
+    index = FUZZY_INDEX
+    counts = {}
+    for gram in _bigrams(candidate):
+        for e_idx in index["by_bigram"].get(gram, ()):
+            counts[e_idx] = counts.get(e_idx, 0) + 1
+    best = {}
+    for e_idx, shared in counts.items():
+        form, a_idx, kw, grams = index["entries"][e_idx]
+        limit = _fuzzy_max_distance(len(form))
+        # each edit destroys at most two bigrams, so fewer shared ones rule the keyword out
+        if shared < len(grams) - 2 * limit:
+            continue
+        dist = _ocr_edit_distance(candidate, form, limit)
+        if dist > limit or (dist == 0 and not repaired):
+            continue
+        confidence = round(1 - (dist + (FUZZY_REPAIR_PENALTY if repaired else 0)) / len(form), 2)
+        if confidence >= FUZZY_MIN_CONFIDENCE and confidence > best.get(a_idx, (None, None, 0))[2]:
+            best[a_idx] = (a_idx, kw, confidence)
+    return tuple(best.values())
+
+@lru_cache(maxsize=65536)
+def _fuzzy_word_hits(word, joined=False):
+    """Fuzzy hits for one token (or a split pair glued back together), cached across scans."""
+    index = FUZZY_INDEX
+    hits = ()
+    fixed = word.translate(_OCR_DIGIT_FIXES)
+    for wrong, right in _OCR_GLYPH_FIXES:
+        fixed = fixed.replace(wrong, right)
+    if fixed != word and fixed not in FUZZY_IGNORE_WORDS:
+        hits += _fuzzy_lookup(fixed, True)
+    if (word.isalpha() and index["min_len"] - 2 <= len(word) <= index["max_len"] + 2
+            and word not in FUZZY_IGNORE_WORDS and (joined or word not in index["exact"])):
+        hits += _fuzzy_lookup(word, joined)
+    return hits
+
+def detect_fuzzy_allergens(raw_text, skip=()):
+    """
+    Map allergen index -> (keyword, OCR text, confidence) for allergens found
+    only approximately, plus whether every candidate was checked within the
+    budget. Allergens in `skip` (already matched exactly) are ignored.
+    """
+    # CPU time of this thread, so time spent waiting on the GIL or other work doesn't count
+    deadline = time.thread_time() + FUZZY_BUDGET_MS / 1000.0
+    tokens = _FUZZY_TOKEN_RE.findall(raw_text.lower())
+    # each distinct token once, then adjacent pairs where one side is a short fragment ("wh eat")
+    candidates = [(tok, tok, False) for tok in dict.fromkeys(tokens)]
+    candidates += [(f"{a} {b}", a + b, True) for a, b in dict.fromkeys(zip(tokens, tokens[1:]))
+                   if len(a) <= 3 or len(b) <= 3]
+    hits = {}
+    for seen, word, joined in candidates:
+        if time.thread_time() > deadline:
+            inc("fuzzy_budget_exhausted_total")
+            return hits, False
+        for a_idx, kw, confidence in _fuzzy_word_hits(word, joined):
+            if a_idx not in skip and confidence > hits.get(a_idx, (None, None, 0))[2]:
+                hits[a_idx] = (kw, seen, confidence)
+    return hits, True
+
+# Fingerprint of everything that decides detect_allergens_from_text's output.
+# Scans store the version they were evaluated with; `flask reevaluate-history`
+# re-runs the ones evaluated under any other version.
+RULESET_VERSION = hashlib.sha256(json.dumps([
+    PREDEFINED_ALLERGENS, sorted(PRECAUTIONARY_PHRASES), sorted(FREE_FROM_MARKERS),
+    [FUZZY_MIN_CONFIDENCE, sorted(FUZZY_IGNORE_WORDS)] if FUZZY_MATCHING else None,
+]).encode()).hexdigest()[:16]
+
 
 DISPLAY_NAME = {
     "milk": "Milk / Dairy",
@@ -91,48 +398,931 @@ DISPLAY_NAME = {
     "lupin": "Lupin"
 }
 
+# ---------------- metrics ----------------
+# Per-process Prometheus-style histograms/counters, exposed on /metrics.
+# Send "X-Trace-Stages: 1" with a request to get its stage breakdown back
+# in a Server-Timing response header.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+
+METRIC_HELP = {
+    "scan_stage_seconds": ("histogram", "Time spent in each scan pipeline stage."),
+    "db_query_seconds": ("histogram", "Time spent executing a single database statement."),
+    "db_queries_per_request": ("histogram", "Database statements executed per HTTP request."),
+    "http_request_seconds": ("histogram", "HTTP request latency by endpoint."),
+    "http_requests_total": ("counter", "HTTP requests by endpoint and status code."),
+    "fuzzy_budget_exhausted_total": ("counter", "Scans whose fuzzy allergen pass hit FUZZY_BUDGET_MS."),
+    "http_compression_saved_bytes_total": ("counter", "Response bytes saved by gzip/brotli encoding of dynamic responses."),
+}
+
+_metrics_lock = threading.Lock()
+_histograms = {}
+_counters = {}
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+def observe(name, value, buckets=LATENCY_BUCKETS, **labels):
+    key = (name, _label_key(labels))
+    with _metrics_lock:
+        hist = _histograms.get(key)
+        if hist is None:
+            hist = _histograms[key] = {"buckets": buckets, "counts": [0] * len(buckets), "sum": 0.0, "count": 0}
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                hist["counts"][i] += 1
+        hist["sum"] += value
+        hist["count"] += 1
+
+def inc(name, amount=1, **labels):
+    key = (name, _label_key(labels))
+    with _metrics_lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+def record_stage(stage, seconds):
+    observe("scan_stage_seconds", seconds, stage=stage)
+    if has_request_context() and 'stage_timings' in g:
+        g.stage_timings[stage] = g.stage_timings.get(stage, 0.0) + seconds
+
+@contextmanager
+def timed_stage(stage):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - started)
+
+def _record_db_query(seconds):
+    observe("db_query_seconds", seconds)
+    if has_request_context() and 'db_queries' in g:
+        g.db_queries += 1
+        g.db_seconds += seconds
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    escaped = ('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in pairs)
+    return "{" + ",".join(escaped) + "}"
+
+def render_metrics():
+    """Current metrics in the Prometheus text exposition format."""
+    lines = []
+    with _metrics_lock:
+        histograms = sorted((k, dict(v, counts=list(v["counts"]))) for k, v in _histograms.items())
+        counters = sorted(_counters.items())
+    described = set()
+
+    def describe(name):
+        if name not in described and name in METRIC_HELP:
+            kind, text = METRIC_HELP[name]
+            lines.append(f"# HELP {name} {text}")
+            lines.append(f"# TYPE {name} {kind}")
+        described.add(name)
+
+    for (name, labels), hist in histograms:
+        describe(name)
+        for bound, count in zip(hist["buckets"], hist["counts"]):
+            lines.append(f"{name}_bucket{_format_labels(labels, [('le', bound)])} {count}")
+        lines.append(f"{name}_bucket{_format_labels(labels, [('le', '+Inf')])} {hist['count']}")
+        lines.append(f"{name}_sum{_format_labels(labels)} {hist['sum']:.6f}")
+        lines.append(f"{name}_count{_format_labels(labels)} {hist['count']}")
+    for (name, labels), value in counters:
+        describe(name)
+        lines.append(f"{name}{_format_labels(labels)} {value}")
+
+    gauges = [("write_behind_queue_depth", "Scan history/feedback writes waiting to be committed.", write_queue_depth())]
+    gauges += [(f"ocr_cache_{k}_total", f"OCR cache {k.replace('_', ' ')}.", v) for k, v in ocr_cache_stats.items()]
+    gauges += [(f"write_behind_{k}_total", f"Write-behind items {k.replace('_', ' ')}.", v) for k, v in write_behind_stats.items()]
+    for name, text, value in gauges:
+        kind = "counter" if name.endswith("_total") else "gauge"
+        lines += [f"# HELP {name} {text}", f"# TYPE {name} {kind}", f"{name} {value}"]
+    return "\n".join(lines) + "\n"
+
+@app.before_request
+def start_request_metrics():
+    g.request_started = time.perf_counter()
+    g.stage_timings = {}
+    g.db_queries = 0
+    g.db_seconds = 0.0
+
+@app.after_request
+def finish_request_metrics(response):
+    if 'request_started' not in g:
+        return response
+    endpoint = request.endpoint or 'unknown'
+    elapsed = time.perf_counter() - g.request_started
+    observe("http_request_seconds", elapsed, endpoint=endpoint)
+    observe("db_queries_per_request", g.db_queries, buckets=COUNT_BUCKETS, endpoint=endpoint)
+    inc("http_requests_total", endpoint=endpoint, status=response.status_code)
+    if request.headers.get('X-Trace-Stages') == '1':
+        parts = [f"{stage};dur={seconds * 1000:.2f}" for stage, seconds in g.stage_timings.items()]
+        parts.append(f'db;dur={g.db_seconds * 1000:.2f};desc="{g.db_queries} queries"')
+        parts.append(f"total;dur={elapsed * 1000:.2f}")
+        response.headers['Server-Timing'] = ", ".join(parts)
+    return response
+
+@app.route('/metrics')
+def metrics():
+    if METRICS_TOKEN and request.headers.get('Authorization') != f"Bearer {METRICS_TOKEN}":
+        return jsonify({'error': 'Unauthorized'}), 401
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+# ---------------- response compression & HTTP caching ----------------
+# JSON/HTML bodies are gzip- (or, when the optional `brotli` module is
+# installed, brotli-) encoded for clients that accept it. Static files are
+# compressed once per file version. Pages backed by slowly changing data
+# answer conditional GETs with 304 before doing any rendering work, and
+# static URLs carry a content hash so browsers may cache them for a year.
+COMPRESS_MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE', '1024'))
+COMPRESS_LEVEL = int(os.environ.get('COMPRESS_LEVEL', '6'))
+BROTLI_QUALITY = int(os.environ.get('BROTLI_QUALITY', '5'))
+STATIC_MAX_AGE = int(os.environ.get('STATIC_MAX_AGE', str(365 * 86400)))
+COMPRESSIBLE_MIMETYPES = frozenset({
+    'application/json', 'application/javascript', 'text/javascript', 'text/html',
+    'text/css', 'text/plain', 'text/csv', 'image/svg+xml',
+})
+
+@lru_cache(maxsize=None)
+def _brotli():
+    try:
+        import brotli
+    except ImportError:
+        return None
+    return brotli
+
+def compress_body(data, encoding):
+    if encoding == 'br':
+        return _brotli().compress(data, quality=BROTLI_QUALITY)
+    return gzip.compress(data, COMPRESS_LEVEL, mtime=0)
+
+@lru_cache(maxsize=128)
+def _compressed_asset(path, mtime, encoding):
+    # Keyed on mtime so an edited file is re-read; None when not worth encoding
+    with open(path, 'rb') as f:
+        data = f.read()
+    return compress_body(data, encoding) if len(data) >= COMPRESS_MIN_SIZE else None
+
+@lru_cache(maxsize=128)
+def _asset_digest(path, mtime):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()[:12]
+
+def asset_url(filename):
+    """url_for('static') plus a content hash, so the URL changes whenever the file does."""
+    path = os.path.join(app.static_folder, filename)
+    try:
+        version = _asset_digest(path, os.path.getmtime(path))
+    except OSError:
+        return url_for('static', filename=filename)
+    return url_for('static', filename=filename, v=version)
+
+@lru_cache(maxsize=None)
+def _build_tag():
+    # Code, templates and assets shape every rendered response, so a deploy
+    # must invalidate ETags handed out by the previous one.
+    digest = hashlib.sha1()
+    roots = [os.path.join(app.root_path, app.template_folder), app.static_folder]
+    paths = [os.path.abspath(__file__)] + sorted(
+        os.path.join(d, f) for root in roots for d, _, files in os.walk(root) for f in files)
+    for path in paths:
+        with open(path, 'rb') as f:
+            digest.update(path.encode() + b'\0' + f.read())
+    return digest.hexdigest()[:12]
+
+def _parse_utc(value):
+    """datetime for a 'YYYY-MM-DD HH:MM:SS' UTC timestamp or unix time (None passes through)."""
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return datetime.fromtimestamp(int(value), timezone.utc)
+    if isinstance(value, datetime):
+        return value.replace(microsecond=0) if value.tzinfo else value.replace(tzinfo=timezone.utc, microsecond=0)
+    try:
+        return datetime.strptime(str(value)[:19], '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc)
+    except ValueError:
+        return None
+
+def conditional_response(validator, last_modified, render):
+    """
+    Serve render() with a weak ETag derived from `validator` (which must change
+    whenever the response would), or an empty 304 if the client's copy is
+    still current - in which case render() is never called.
+    """
+    etag = hashlib.sha1(repr((validator, _build_tag())).encode()).hexdigest()[:20]
+    if request.if_none_match:
+        fresh = request.if_none_match.contains_weak(etag)
+    else:
+        fresh = (last_modified is not None and request.if_modified_since is not None
+                 and last_modified <= request.if_modified_since)
+    response = Response(status=304) if fresh else make_response(render())
+    response.set_etag(etag, weak=True)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    # Per-user pages: browsers may keep them but must revalidate every time
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+@app.after_request
+def cache_static_assets(response):
+    if request.endpoint != 'static' or response.status_code not in (200, 304):
+        return response
+    filename = (request.view_args or {}).get('filename', '')
+    version = request.args.get('v')
+    path = safe_join(app.static_folder, filename)
+    try:
+        current = path and _asset_digest(path, os.path.getmtime(path))
+    except OSError:
+        current = None
+    if version and version == current:
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = STATIC_MAX_AGE
+        response.cache_control.immutable = True
+    else:
+        # Unversioned (or outdated) URL: keep it, but revalidate
+        response.cache_control.no_cache = True
+    return response
+
+@app.after_request
+def compress_response(response):
+    if response.mimetype not in COMPRESSIBLE_MIMETYPES:
+        return response
+    response.vary.add('Accept-Encoding')
+    if response.status_code != 200 or 'Content-Encoding' in response.headers:
+        return response
+    encoding = request.accept_encodings.best_match(['br', 'gzip'] if _brotli() else ['gzip'])
+    if encoding is None:
+        return response
+
+    if request.endpoint == 'static' and response.direct_passthrough:
+        path = safe_join(app.static_folder, (request.view_args or {}).get('filename', ''))
+        try:
+            body = path and _compressed_asset(path, os.path.getmtime(path), encoding)
+        except OSError:
+            body = None
+        if not body:
+            return response
+        response.close()
+        response.direct_passthrough = False
+        response.set_data(body)
+    elif response.is_streamed or response.direct_passthrough:
+        # Streamed NDJSON/exports must reach the client as they are produced
+        return response
+    else:
+        data = response.get_data()
+        if len(data) < COMPRESS_MIN_SIZE:
+            return response
+        body = compress_body(data, encoding)
+        response.set_data(body)
+        inc("http_compression_saved_bytes_total", len(data) - len(body), encoding=encoding)
+
+    response.headers['Content-Encoding'] = encoding
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        # Same entity, different bytes: only weakly equal to the identity body
+        response.set_etag(etag, weak=True)
+    return response
+
 # ---------------- DB helpers ----------------
-def get_db_connection():
-    conn = sqlite3.connect(DB_PATH)
+class PooledSQLiteConnection(sqlite3.Connection):
+    """
+    SQLite connection kept open for the life of its thread.
+    close() only discards an unfinished transaction so existing helpers can
+    keep their connect/close pattern while reusing one WAL-mode connection
+    (and its prepared-statement cache) per thread.
+    """
+    def close(self):
+        if self.in_transaction:
+            self.rollback()
+
+    def execute(self, sql, params=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, params)
+        finally:
+            _record_db_query(time.perf_counter() - started)
+
+    def executemany(self, sql, seq_of_params):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_params)
+        finally:
+            _record_db_query(time.perf_counter() - started)
+
+    def close_for_real(self):
+        super().close()
+
+_db_local = threading.local()
+
+def _sqlite_connection():
+    # Connections must not cross a fork (gunicorn --preload, process pools)
+    conn = getattr(_db_local, 'conn', None)
+    if conn is not None and _db_local.pid == os.getpid():
+        return conn
+    conn = sqlite3.connect(DB_PATH, timeout=DB_BUSY_TIMEOUT,
+                           cached_statements=DB_STATEMENT_CACHE, factory=PooledSQLiteConnection)
     conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    _db_local.conn = conn
+    _db_local.pid = os.getpid()
+    return conn
+
+_INSERT_OR_REPLACE_RE = re.compile(r"INSERT OR REPLACE INTO (\w+) \(([^)]*)\)")
+
+def _pg_upsert(match):
+    # INSERT OR REPLACE -> upsert on the first listed column, which is the
+    # table's primary key in every such statement here
+    columns = [c.strip() for c in match.group(2).split(",")]
+    updates = ", ".join(f"{c} = EXCLUDED.{c}" for c in columns[1:])
+    return f"INSERT INTO {match.group(1)} ({match.group(2)})", f" ON CONFLICT ({columns[0]}) DO UPDATE SET {updates}"
+
+@lru_cache(maxsize=512)
+def _pg_sql(sql):
+    # Translate the SQLite dialect used in this module to PostgreSQL
+    sql = sql.replace('%', '%%').replace('?', '%s')
+    sql = sql.replace('INTEGER PRIMARY KEY AUTOINCREMENT', 'SERIAL PRIMARY KEY').replace('DATETIME', 'TIMESTAMP')
+    sql = re.sub(r"\bBLOB\b", "BYTEA", sql)
+    # REAL is float4 on PostgreSQL: ~7 digits, so unix times would be off by minutes
+    sql = re.sub(r"\bREAL\b", "DOUBLE PRECISION", sql)
+    if 'INSERT OR IGNORE' in sql:
+        sql = sql.replace('INSERT OR IGNORE', 'INSERT').rstrip().rstrip(';') + ' ON CONFLICT DO NOTHING'
+    match = _INSERT_OR_REPLACE_RE.search(sql)
+    if match:
+        insert, conflict = _pg_upsert(match)
+        sql = (sql[:match.start()] + insert + sql[match.end():]).rstrip().rstrip(';') + conflict
+    return sql
+
+class PostgresConnection:
+    """
+    Minimal sqlite3-style wrapper around a connection borrowed from a psycopg2 pool.
+    As with SQLite, a thread reuses one connection: nested helpers (e.g.
+    get_product_by_barcode -> get_reference_data) share it, and it goes back
+    to the pool when the outermost caller closes it. Checkout waits up to
+    DB_BUSY_TIMEOUT for a free connection instead of failing at once.
+    """
+    def __init__(self, pool, slots):
+        if not slots.acquire(timeout=DB_BUSY_TIMEOUT):
+            raise psycopg2.pool.PoolError(f"no database connection free after {DB_BUSY_TIMEOUT}s")
+        try:
+            self._raw = pool.getconn()
+        except Exception:
+            slots.release()
+            raise
+        self._pool = pool
+        self._slots = slots
+        self._depth = 1
+
+    def cursor(self):
+        return PostgresCursor(self._raw.cursor(cursor_factory=psycopg2.extras.DictCursor))
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        return self.cursor().executemany(sql, seq_of_params)
+
+    def commit(self):
+        self._raw.commit()
+
+    def rollback(self):
+        self._raw.rollback()
+
+    def close(self):
+        if self._raw is None:
+            return
+        self._depth -= 1
+        if self._depth:
+            return
+        try:
+            self._raw.rollback()
+            self._pool.putconn(self._raw)
+        finally:
+            self._raw = None
+            self._slots.release()
+            if getattr(_pg_local, 'conn', None) is self:
+                _pg_local.conn = None
+
+class PostgresCursor:
+    def __init__(self, cur):
+        self._cur = cur
+
+    def execute(self, sql, params=()):
+        started = time.perf_counter()
+        try:
+            self._cur.execute(_pg_sql(sql), tuple(params))
+        finally:
+            _record_db_query(time.perf_counter() - started)
+        return self
+
+    def executemany(self, sql, seq_of_params):
+        started = time.perf_counter()
+        try:
+            self._cur.executemany(_pg_sql(sql), [tuple(p) for p in seq_of_params])
+        finally:
+            _record_db_query(time.perf_counter() - started)
+        return self
+
+    def fetchone(self):
+        return self._cur.fetchone()
+
+    def fetchall(self):
+        return self._cur.fetchall()
+
+    def fetchmany(self, size):
+        return self._cur.fetchmany(size)
+
+    def __iter__(self):
+        return iter(self._cur)
+
+    @property
+    def rowcount(self):
+        return self._cur.rowcount
+
+_pg_pool = {}
+_pg_local = threading.local()
+
+def _postgres_connection():
+    if _pg_pool.get('pid') != os.getpid():
+        _pg_pool['pool'] = psycopg2.pool.ThreadedConnectionPool(1, DB_POOL_MAX, DATABASE_URL)
+        _pg_pool['slots'] = threading.BoundedSemaphore(DB_POOL_MAX)
+        _pg_pool['pid'] = os.getpid()
+        _pg_local.__dict__.clear()
+    conn = getattr(_pg_local, 'conn', None)
+    if conn is not None and conn._pool is _pg_pool['pool'] and conn._raw is not None:
+        conn._depth += 1
+        return conn
+    conn = _pg_local.conn = PostgresConnection(_pg_pool['pool'], _pg_pool['slots'])
     return conn
+
+DB_BACKENDS = {"sqlite": _sqlite_connection, "postgres": _postgres_connection}
+DB_BACKEND = "postgres" if DATABASE_URL.startswith(("postgres://", "postgresql://")) else "sqlite"
+DB_INTEGRITY_ERRORS = (sqlite3.IntegrityError,)
+if DB_BACKEND == "postgres":
+    import psycopg2
+    import psycopg2.extras
+    import psycopg2.pool
+    DB_INTEGRITY_ERRORS += (psycopg2.IntegrityError,)
+
+def get_db_connection():
+    return DB_BACKENDS[DB_BACKEND]()
+
+@contextmanager
+def db_connection():
+    # get_db_connection() for a with-block: closed (uncommitted work rolled
+    # back) however the block is left, so errors can't strand a connection
+    conn = get_db_connection()
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+@app.teardown_appcontext
+def release_db_connection(exc):
+    # Never let a half-finished transaction leak into the next request on this thread
+    conn = getattr(_db_local, 'conn', None)
+    if conn is not None and _db_local.pid == os.getpid() and conn.in_transaction:
+        conn.rollback()
+    # A PostgreSQL connection still checked out here was missed by a close()
+    # (or close() was skipped by an error): roll it back and return it to the pool
+    conn = getattr(_pg_local, 'conn', None)
+    if conn is not None and conn._raw is not None and _pg_pool.get('pid') == os.getpid():
+        conn._depth = 1
+        conn.close()
+
+class TTLCache:
+    """Small thread-safe LRU mapping whose entries also expire after `ttl` seconds."""
+    MISSING = object()
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=MISSING):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                return default
+            self._data.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
 # ---------- Additional DB helpers (paste below existing helpers) ----------
+# User rows are memoised per request in g and process-wide for USER_CACHE_TTL
+# seconds (other workers see allergy edits once their entry expires).
+USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', '4096'))
+USER_CACHE_TTL = float(os.environ.get('USER_CACHE_TTL', '60'))
+_user_cache = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+
+def _load_user(user_id):
+    cached = _user_cache.get(user_id)
+    if cached is not TTLCache.MISSING:
+        return cached
+    with db_connection() as conn:
+        row = conn.execute("SELECT * FROM users WHERE id = ?", (user_id,)).fetchone()
+    user = None
+    if row:
+        user = dict(row)
+        try:
+            parsed = json.loads(user.get('allergies') or '[]')
+        except ValueError:
+            parsed = []
+        user['allergy_list'] = tuple(parsed)
+        user['allergy_set'] = frozenset(parsed)
+        user['allergy_mask'] = allergen_mask(parsed)
+    _user_cache.put(user_id, user)
+    return user
+
 def get_user_by_id(user_id):
-    conn = get_db_connection()
-    row = conn.execute("SELECT * FROM users WHERE id = ?", (user_id,)).fetchone()
-    conn.close()
-    return dict(row) if row else None
+    """User row as a dict, plus parsed `allergy_list` (tuple) and `allergy_set` (frozenset)."""
+    if user_id is None:
+        return None
+    if has_request_context():
+        memo = g.setdefault('_user_memo', {})
+        if user_id not in memo:
+            memo[user_id] = _load_user(user_id)
+        user = memo[user_id]
+    else:
+        user = _load_user(user_id)
+    # shallow copy so callers can't mutate the cached record
+    return dict(user) if user else None
+
+def invalidate_user_cache(user_id):
+    _user_cache.invalidate(user_id)
+    if has_request_context():
+        g.get('_user_memo', {}).pop(user_id, None)
 
 def update_user_allergies(user_id, allergies_list):
-    conn = get_db_connection()
-    conn.execute("UPDATE users SET allergies = ? WHERE id = ?", (json.dumps(allergies_list), user_id))
-    conn.commit()
-    conn.close()
+    with db_connection() as conn:
+        conn.execute("UPDATE users SET allergies = ?, allergy_mask = ? WHERE id = ?",
+                     (json.dumps(allergies_list), allergen_mask(allergies_list), user_id))
+        conn.commit()
+    invalidate_user_cache(user_id)
+
+# ---------------- scan text storage ----------------
+# OCR text is stored once per distinct content in text_blobs (sha256 key,
+# zlib-compressed) and scan_history rows point at it via ingredients_hash.
+def store_text_blob(conn, text):
+    """Insert text into text_blobs if new; returns its hash. Caller commits."""
+    raw = text.encode('utf-8')
+    digest = hashlib.sha256(raw).hexdigest()
+    conn.execute("INSERT OR IGNORE INTO text_blobs (hash, data, size) VALUES (?, ?, ?)",
+                 (digest, zlib.compress(raw, 6), len(raw)))
+    return digest
+
+def load_text_blobs(conn, hashes):
+    """Map hash -> decompressed text for the given blob hashes."""
+    hashes = [h for h in set(hashes) if h]
+    texts = {}
+    for start in range(0, len(hashes), 500):
+        chunk = hashes[start:start + 500]
+        placeholders = ",".join("?" * len(chunk))
+        for r in conn.execute(f"SELECT hash, data FROM text_blobs WHERE hash IN ({placeholders})", chunk).fetchall():
+            texts[r['hash']] = zlib.decompress(bytes(r['data'])).decode('utf-8')
+    return texts
+
+def get_scan_text(row):
+    # Full OCR text of a scan_history row, whether migrated to text_blobs or not
+    if row['ingredients_hash']:
+        with db_connection() as conn:
+            text = load_text_blobs(conn, [row['ingredients_hash']]).get(row['ingredients_hash'], '')
+        return text
+    if 'ingredients' in row:
+        return row['ingredients'] or ''
+    # Listings leave out the inline column, which rows awaiting the text backfill still use
+    with db_connection() as conn:
+        found = conn.execute("SELECT ingredients FROM scan_history WHERE id = ?", (row['id'],)).fetchone()
+    return (found['ingredients'] if found else None) or ''
+
+class ScanHistoryRow(dict):
+    """scan_history row whose 'ingredients' text is only fetched and decompressed when read."""
+    def __missing__(self, key):
+        if key != 'ingredients':
+            raise KeyError(key)
+        text = get_scan_text(self)
+        self['ingredients'] = text
+        return text
+
+SCAN_HISTORY_LIST_COLUMNS = "id, username, product_name, detected_allergens, timestamp, ingredients_hash"
+
+def _migrate_scan_text_to_blobs(conn, batch_size=500, commit=True):
+    # Move legacy inline scan_history.ingredients into text_blobs
+    while True:
+        rows = conn.execute("SELECT id, ingredients FROM scan_history WHERE ingredients_hash IS NULL "
+                            "AND ingredients IS NOT NULL LIMIT ?", (batch_size,)).fetchall()
+        if not rows:
+            break
+        for r in rows:
+            conn.execute("UPDATE scan_history SET ingredients_hash = ?, ingredients = NULL WHERE id = ?",
+                         (store_text_blob(conn, r['ingredients']), r['id']))
+        if commit:
+            conn.commit()
 
-def get_all_feedback(limit=200):
-    conn = get_db_connection()
-    rows = conn.execute("SELECT * FROM feedback ORDER BY timestamp DESC LIMIT ?", (limit,)).fetchall()
-    conn.close()
-    return [dict(r) for r in rows]
+def _column_exists(conn, table, column):
+    # Catalog lookup rather than a failing SELECT, so it is safe mid-transaction
+    if DB_BACKEND == "postgres":
+        return conn.execute("SELECT 1 FROM information_schema.columns WHERE table_name = ? AND column_name = ?",
+                            (table, column)).fetchone() is not None
+    return any(r[1] == column for r in conn.execute(f"PRAGMA table_info({table})").fetchall())
 
-def get_feedback_by_user(username, limit=200):
-    conn = get_db_connection()
-    rows = conn.execute("SELECT * FROM feedback WHERE username = ? ORDER BY timestamp DESC LIMIT ?", (username, limit)).fetchall()
-    conn.close()
+def compact_scan_history(retention_days=None, vacuum=False):
+    """
+    Retention/compaction: optionally drop scans older than retention_days,
+    then delete text blobs no scan refers to any more. Returns counts.
+    """
+    with db_connection() as conn:
+        removed_scans = 0
+        if retention_days is not None:
+            cutoff = (datetime.now(timezone.utc) - timedelta(days=retention_days)).strftime('%Y-%m-%d %H:%M:%S')
+            conn.execute("DELETE FROM scan_detections WHERE scan_id IN (SELECT id FROM scan_history WHERE timestamp < ?)", (cutoff,))
+            removed_scans = conn.execute("DELETE FROM scan_history WHERE timestamp < ?", (cutoff,)).rowcount
+        removed_blobs = conn.execute("DELETE FROM text_blobs WHERE NOT EXISTS "
+                                     "(SELECT 1 FROM scan_history h WHERE h.ingredients_hash = text_blobs.hash)").rowcount
+        conn.commit()
+    if vacuum and DB_BACKEND == "sqlite":
+        raw = sqlite3.connect(DB_PATH, timeout=DB_BUSY_TIMEOUT)
+        raw.execute("VACUUM")
+        raw.close()
+    return {"scans_removed": removed_scans, "blobs_removed": removed_blobs}
+
+@app.cli.command('compact-history')
+@click.option('--retention-days', type=int, default=None, help='Delete scans older than this many days.')
+@click.option('--vacuum', is_flag=True, help='Run VACUUM afterwards to give space back to the OS (SQLite).')
+def compact_history_command(retention_days, vacuum):
+    """Apply scan history retention and drop unreferenced OCR text blobs."""
+    with db_connection() as conn:
+        _migrate_scan_text_to_blobs(conn)
+    result = compact_scan_history(retention_days, vacuum)
+    click.echo(f"Removed {result['scans_removed']} scans and {result['blobs_removed']} text blobs.")
+
+# Listings are newest-first with keyset ("seek") pagination: a cursor is the
+# (timestamp, id) of the last row shown, and the next page starts strictly
+# after it, so every page is one index range scan however deep it is.
+def encode_cursor(row):
+    timestamp = row['timestamp']
+    if isinstance(timestamp, datetime):
+        # psycopg2 returns datetimes; keep microseconds so the seek stays exact
+        timestamp = timestamp.isoformat(sep=' ')
+    raw = json.dumps([timestamp, row['id']])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    # Returns (timestamp string, id) or None for a missing/garbled cursor
+    if not cursor:
+        return None
+    try:
+        timestamp, row_id = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        datetime.fromisoformat(timestamp)  # PostgreSQL would reject anything else
+        return timestamp, int(row_id)
+    except (ValueError, TypeError):
+        return None
+
+def next_cursor(rows, limit):
+    return encode_cursor(rows[-1]) if rows and len(rows) >= limit else None
+
+def _keyset_query(table, filters=(), before=None, limit=200, columns="*"):
+    where, params = [], []
+    for column, value in filters:
+        where.append(f"{column} = ?")
+        params.append(value)
+    if before:
+        where.append("(timestamp, id) < (?, ?)")
+        params.extend(before)
+    sql = f"SELECT {columns} FROM {table}"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY timestamp DESC, id DESC LIMIT ?"
+    return sql, params + [limit]
+
+def get_all_feedback(limit=200, before=None):
+    with db_connection() as conn:
+        rows = conn.execute(*_keyset_query("feedback", before=before, limit=limit)).fetchall()
     return [dict(r) for r in rows]
 
-def get_scan_history_by_user(username, limit=200):
-    conn = get_db_connection()
-    rows = conn.execute("SELECT * FROM scan_history WHERE username = ? ORDER BY timestamp DESC LIMIT ?", (username, limit)).fetchall()
-    conn.close()
+def get_feedback_by_user(username, limit=200, before=None):
+    with db_connection() as conn:
+        rows = conn.execute(*_keyset_query("feedback", [("username", username)], before, limit)).fetchall()
     return [dict(r) for r in rows]
 
-def init_db():
-    conn = get_db_connection()
-    cur = conn.cursor()
+def get_scan_history_by_user(username, limit=200, before=None):
+    with db_connection() as conn:
+        rows = conn.execute(*_keyset_query("scan_history", [("username", username)], before, limit,
+                                           SCAN_HISTORY_LIST_COLUMNS)).fetchall()
+    history = [ScanHistoryRow(r) for r in rows]
+    detections = get_detections_for_scans(h['id'] for h in history)
+    for h in history:
+        # scans awaiting the scan_detections backfill fall back to the stored allergen list
+        h['detections'] = detections[h['id']] or [{"allergen": a, "severity": None, "matched": None}
+                                                  for a in (h['detected_allergens'] or '').split(',') if a]
+    return history
+
+def explain_query_plan(sql, params=()):
+    """SQLite query plan details for a statement, one string per plan step."""
+    with db_connection() as conn:
+        rows = conn.execute("EXPLAIN QUERY PLAN " + sql, params).fetchall()
+    return [r[3] for r in rows]
+
+def check_listing_indexes():
+    """
+    Verify that every paginated listing is answered from an index without a
+    sort step. Returns {query name: [problem plan steps]} for failing queries.
+    """
+    cursor = ("2000-01-01 00:00:00", 1)
+    queries = {
+        "all_feedback": _keyset_query("feedback", before=cursor),
+        "feedback_by_user": _keyset_query("feedback", [("username", "u")], cursor),
+        "scan_history_by_user": _keyset_query("scan_history", [("username", "u")], cursor),
+        "scan_history_first_page": _keyset_query("scan_history", [("username", "u")]),
+        "detections_by_allergen": ("SELECT COUNT(DISTINCT scan_id) FROM scan_detections WHERE allergen = ? AND timestamp >= ?",
+                                   ["milk", "2000-01-01"]),
+    }
+    problems = {}
+    for name, (sql, params) in queries.items():
+        bad = [step for step in explain_query_plan(sql, params)
+               if step.startswith("SCAN") or "TEMP B-TREE FOR ORDER BY" in step]
+        if bad:
+            problems[name] = bad
+    return problems
+
+@app.cli.command('check-indexes')
+def check_indexes_command():
+    """Fail if a listing query would scan a table or sort instead of using its index."""
+    problems = check_listing_indexes()
+    for name, steps in problems.items():
+        click.echo(f"{name}: {'; '.join(steps)}", err=True)
+    if problems:
+        raise SystemExit(1)
+    click.echo("All listing queries use their indexes.")
+
+def _insert_returning_id(conn, sql, params):
+    if DB_BACKEND == "postgres":
+        return conn.execute(sql + " RETURNING id", params).fetchone()[0]
+    return conn.execute(sql, params).lastrowid
+
+def _insert_scan_detections(conn, scan_id, username, timestamp, detections):
+    # detections: dicts from detect_allergens_from_text (duplicates are collapsed)
+    rows = {(d["allergen"], d.get("severity"), d.get("matched")) for d in detections}
+    conn.executemany("INSERT INTO scan_detections (scan_id, username, allergen, severity, matched, timestamp) VALUES (?, ?, ?, ?, ?, ?)",
+                     [(scan_id, username, a, sev, m, timestamp) for a, sev, m in sorted(rows, key=str)])
+
+# ---------------- data backfills ----------------
+# Migrations only change the schema: rewriting every existing row could keep
+# a booting worker past its timeout. A migration that needs existing rows
+# converted registers a backfill instead, and `flask backfill` works through
+# the rows that existed at that point (ids up to max_id) one batch per
+# transaction, recording how far it got so an interrupted run resumes there.
+# Rows written after the migration are already in the new form.
+BACKFILL_BATCH = int(os.environ.get('BACKFILL_BATCH', '500'))
+
+def _backfill_scan_text_blobs(conn, lo, hi):
+    # Move legacy inline scan_history.ingredients into text_blobs
+    rows = conn.execute("SELECT id, ingredients FROM scan_history WHERE id > ? AND id <= ? "
+                        "AND ingredients_hash IS NULL AND ingredients IS NOT NULL", (lo, hi)).fetchall()
+    for r in rows:
+        conn.execute("UPDATE scan_history SET ingredients_hash = ?, ingredients = NULL WHERE id = ?",
+                     (store_text_blob(conn, r['ingredients']), r['id']))
+
+def _backfill_scan_detections(conn, lo, hi):
+    """
+    Rebuild scan_detections for existing scan_history rows. Severity and the
+    matched keyword are recovered by re-running detection on the stored text;
+    allergens that no longer match are kept with severity NULL. Scans that
+    already have rows (e.g. from reevaluate-history) are left alone.
+    """
+    rows = conn.execute("SELECT id, username, ingredients, ingredients_hash, detected_allergens, timestamp FROM scan_history "
+                        "WHERE id > ? AND id <= ? AND NOT EXISTS "
+                        "(SELECT 1 FROM scan_detections d WHERE d.scan_id = scan_history.id)", (lo, hi)).fetchall()
+    texts = load_text_blobs(conn, [r['ingredients_hash'] for r in rows])
+    for r in rows:
+        stored = [a for a in (r['detected_allergens'] or '').split(',') if a]
+        if not stored:
+            continue
+        text = texts.get(r['ingredients_hash']) or r['ingredients'] or ''
+        redetected = [d for d in detect_allergens_from_text(text) if d['allergen'] in stored]
+        missing = set(stored) - {d['allergen'] for d in redetected}
+        redetected += [{"allergen": a, "severity": None, "matched": None} for a in missing]
+        _insert_scan_detections(conn, r['id'], r['username'], r['timestamp'], redetected)
+
+def _backfill_feedback_counts(conn, lo, hi):
+    # Add existing feedback to the aggregates (add_feedback counts newer rows itself)
+    conn.execute("INSERT INTO feedback_product_counts (product_name, cnt) "
+                 "SELECT COALESCE(product_name, ''), COUNT(*) FROM feedback WHERE id > ? AND id <= ? "
+                 "GROUP BY COALESCE(product_name, '') "
+                 "ON CONFLICT (product_name) DO UPDATE SET cnt = feedback_product_counts.cnt + excluded.cnt", (lo, hi))
+    conn.execute("INSERT INTO feedback_reaction_counts (product_name, reaction, cnt) "
+                 "SELECT COALESCE(product_name, ''), COALESCE(reaction, ''), COUNT(*) FROM feedback WHERE id > ? AND id <= ? "
+                 "GROUP BY COALESCE(product_name, ''), COALESCE(reaction, '') "
+                 "ON CONFLICT (product_name, reaction) DO UPDATE SET cnt = feedback_reaction_counts.cnt + excluded.cnt", (lo, hi))
+
+def _backfill_allergy_mask(conn, lo, hi):
+    rows = conn.execute("SELECT id, allergies FROM users WHERE id > ? AND id <= ?", (lo, hi)).fetchall()
+    conn.executemany("UPDATE users SET allergy_mask = ? WHERE id = ?",
+                     [(allergen_mask(json.loads(r['allergies'] or '[]')), r['id']) for r in rows])
+
+# name -> (table whose ids are walked, step(conn, lo, hi) converting ids in (lo, hi])
+BACKFILLS = {
+    "scan_text_blobs": ("scan_history", _backfill_scan_text_blobs),
+    "scan_detections": ("scan_history", _backfill_scan_detections),
+    "feedback_counts": ("feedback", _backfill_feedback_counts),
+    "allergy_mask": ("users", _backfill_allergy_mask),
+}
 
+def _register_backfill(conn, name):
+    # Called from a migration: convert the rows that exist now, later
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS backfills (
+            name TEXT PRIMARY KEY,
+            last_id INTEGER NOT NULL DEFAULT 0,  -- rows up to here are done
+            max_id INTEGER NOT NULL              -- last row that predates the migration
+        );
+    ''')
+    table = BACKFILLS[name][0]
+    conn.execute(f"INSERT OR IGNORE INTO backfills (name, last_id, max_id) SELECT ?, 0, COALESCE(MAX(id), 0) FROM {table}",
+                 (name,))
+
+def pending_backfills(conn):
+    if not _column_exists(conn, "backfills", "name"):
+        return []
+    return [r['name'] for r in conn.execute("SELECT name FROM backfills WHERE last_id < max_id ORDER BY name").fetchall()]
+
+def _lock_backfill(conn, name):
+    # Start a transaction holding the backfill's row, so concurrent runs take turns per batch
+    if DB_BACKEND == "postgres":
+        return conn.execute("SELECT last_id, max_id FROM backfills WHERE name = ? FOR UPDATE", (name,)).fetchone()
+    conn.execute("BEGIN IMMEDIATE")
+    return conn.execute("SELECT last_id, max_id FROM backfills WHERE name = ?", (name,)).fetchone()
+
+def run_backfills(batch_size=BACKFILL_BATCH, progress=None):
+    """
+    Work through every pending backfill, batch_size rows per transaction.
+    Safe to interrupt and to re-run. Returns {name: rows processed}.
+    """
+    conn = get_db_connection()
+    processed = {}
+    try:
+        for name in pending_backfills(conn):
+            table, step = BACKFILLS[name]
+            processed[name] = 0
+            while True:
+                state = _lock_backfill(conn, name)
+                if state['last_id'] >= state['max_id']:
+                    conn.rollback()
+                    break
+                ids = conn.execute(f"SELECT id FROM {table} WHERE id > ? AND id <= ? ORDER BY id LIMIT ?",
+                                   (state['last_id'], state['max_id'], batch_size)).fetchall()
+                hi = ids[-1]['id'] if ids else state['max_id']
+                step(conn, state['last_id'], hi)
+                conn.execute("UPDATE backfills SET last_id = ? WHERE name = ?", (hi, name))
+                conn.commit()
+                processed[name] += len(ids)
+                if progress:
+                    progress(name, processed[name])
+    finally:
+        conn.close()
+    return processed
+
+@app.cli.command('backfill')
+@click.option('--batch-size', default=BACKFILL_BATCH, show_default=True, help='Rows per transaction.')
+def backfill_command(batch_size):
+    """Convert rows that predate recent migrations (resumable; run after deploying)."""
+    processed = run_backfills(batch_size, progress=lambda name, n: click.echo(f"... {name}: {n} rows"))
+    for name, n in processed.items():
+        click.echo(f"{name}: {n} rows converted.")
+    click.echo("No backfills pending.")
+
+# ---------------- schema migrations ----------------
+# Each migration runs exactly once, in order, inside one locked transaction
+# (BEGIN IMMEDIATE on SQLite, an advisory lock on PostgreSQL) so concurrently
+# booting workers don't race. The number applied is kept in PRAGMA
+# user_version (SQLite) or schema_migrations (PostgreSQL); starting against an
+# up-to-date database costs a single version read. Append new migrations to
+# MIGRATIONS, never edit or reorder existing ones. They run at import time, so
+# they only change the schema (and the small reference tables); converting
+# existing rows is left to a registered backfill (see run_backfills).
+MIGRATION_LOCK_TIMEOUT = float(os.environ.get('MIGRATION_LOCK_TIMEOUT', '300'))
+MIGRATION_LOCK_ID = 0x616c6c67  # arbitrary, shared by every worker
+
+def _migration_base_schema(conn):
     # existing users table (keep as-is)
-    cur.execute('''
+    conn.execute('''
         CREATE TABLE IF NOT EXISTS users (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             username TEXT UNIQUE NOT NULL,
@@ -143,7 +1333,7 @@ def init_db():
     ''')
 
     # Safe alternatives table
-    cur.execute('''
+    conn.execute('''
         CREATE TABLE IF NOT EXISTS safe_alternatives (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             allergen TEXT NOT NULL,
@@ -152,7 +1342,7 @@ def init_db():
     ''')
 
     # Harmful ingredients for health score (weight = penalty points)
-    cur.execute('''
+    conn.execute('''
         CREATE TABLE IF NOT EXISTS harmful_ingredients (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             ingredient TEXT NOT NULL UNIQUE,
@@ -161,7 +1351,7 @@ def init_db():
     ''')
 
     # Predictive risk rules (food item -> possible hidden allergen)
-    cur.execute('''
+    conn.execute('''
         CREATE TABLE IF NOT EXISTS predictive_risks (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             food_item TEXT NOT NULL,
@@ -170,7 +1360,7 @@ def init_db():
     ''')
 
     # Community feedback
-    cur.execute('''
+    conn.execute('''
         CREATE TABLE IF NOT EXISTS feedback (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             username TEXT,
@@ -182,7 +1372,7 @@ def init_db():
     ''')
 
     # Scan history
-    cur.execute('''
+    conn.execute('''
         CREATE TABLE IF NOT EXISTS scan_history (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             username TEXT,
@@ -193,8 +1383,56 @@ def init_db():
         );
     ''')
 
+    # One row per detection of a scan, so per-allergen questions hit an index
+    # instead of parsing scan_history.detected_allergens
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS scan_detections (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            scan_id INTEGER NOT NULL,   -- scan_history.id
+            username TEXT,
+            allergen TEXT NOT NULL,
+            severity TEXT,              -- high / medium / low (NULL for unrecoverable legacy rows)
+            matched TEXT,
+            timestamp DATETIME
+        );
+    ''')
+    # Deduplicated, compressed OCR text referenced by scan_history.ingredients_hash
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS text_blobs (
+            hash TEXT PRIMARY KEY,   -- sha256 of the UTF-8 text
+            data BLOB NOT NULL,      -- zlib-compressed text
+            size INTEGER NOT NULL    -- uncompressed size in bytes
+        );
+    ''')
+    if not _column_exists(conn, "scan_history", "ingredients_hash"):
+        conn.execute("ALTER TABLE scan_history ADD COLUMN ingredients_hash TEXT")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_scan_history_text ON scan_history (ingredients_hash)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_scan_history_user_time ON scan_history (username, timestamp, id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_feedback_user_time ON feedback (username, timestamp, id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_feedback_time ON feedback (timestamp, id)")
+
+    # Feedback aggregates kept up to date by add_feedback (community page reads these)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS feedback_product_counts (
+            product_name TEXT PRIMARY KEY,
+            cnt INTEGER NOT NULL DEFAULT 0
+        );
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_feedback_product_counts_cnt ON feedback_product_counts (cnt)")
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS feedback_reaction_counts (
+            product_name TEXT NOT NULL,
+            reaction TEXT NOT NULL,
+            cnt INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (product_name, reaction)
+        );
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_scan_detections_scan ON scan_detections (scan_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_scan_detections_user_time ON scan_detections (username, timestamp)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_scan_detections_allergen_time ON scan_detections (allergen, timestamp)")
+
     # Hospitals (optional) - for emergency guidance
-    cur.execute('''
+    conn.execute('''
         CREATE TABLE IF NOT EXISTS hospitals (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             name TEXT,
@@ -204,8 +1442,56 @@ def init_db():
         );
     ''')
 
-    conn.commit()
+    # Background OCR jobs (shared by all workers so any of them can answer a status poll)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS ocr_jobs (
+            id TEXT PRIMARY KEY,
+            user_id INTEGER,
+            status TEXT NOT NULL DEFAULT 'pending',  -- pending / done / failed
+            result TEXT,                             -- JSON body of the /scan response
+            error TEXT,
+            created REAL NOT NULL,                   -- unix time
+            deadline REAL NOT NULL
+        );
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_ocr_jobs_created ON ocr_jobs (created)")
+
+    # OCR results keyed by a hash of the uploaded bytes (persistent tier of the OCR cache)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS ocr_cache (
+            hash TEXT PRIMARY KEY,   -- sha256 of the upload
+            phash TEXT,              -- perceptual hash, for near-duplicate photos
+            text TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            last_used REAL NOT NULL
+        );
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_ocr_cache_phash ON ocr_cache (phash)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_ocr_cache_last_used ON ocr_cache (last_used)")
 
+    # Product catalog for barcode scans; allergen analysis is precomputed at import time
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS products (
+            barcode TEXT PRIMARY KEY,
+            name TEXT,
+            ingredients TEXT,
+            detections TEXT,            -- JSON list from detect_allergens_from_text (NULL = not analysed yet)
+            health_score INTEGER,
+            predictive_allergens TEXT,  -- JSON list
+            updated REAL
+        );
+    ''')
+
+def _migration_dedupe_reference(conn):
+    # Older versions re-seeded these tables on every start; keep the first
+    # copy of each row and make the natural key unique from now on
+    for table, key in (("safe_alternatives", "allergen, alternative"),
+                       ("predictive_risks", "food_item, possible_allergen"),
+                       ("hospitals", "name, pincode")):
+        conn.execute(f"DELETE FROM {table} WHERE id NOT IN (SELECT MIN(id) FROM {table} GROUP BY {key})")
+        conn.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS uq_{table} ON {table} ({key})")
+
+def _migration_seed(conn):
     # --- seed small sample data (INSERT OR IGNORE style) ---
     # Safe alternatives
     seed_alt = [
@@ -216,7 +1502,7 @@ def init_db():
         ("wheat", "Rice flour"),
         ("gluten", "Corn flour")
     ]
-    cur.executemany("INSERT INTO safe_alternatives (allergen, alternative) VALUES (?, ?)", seed_alt)
+    conn.executemany("INSERT OR IGNORE INTO safe_alternatives (allergen, alternative) VALUES (?, ?)", seed_alt)
 
     # Harmful ingredients (weight = penalty)
     seed_harmful = [
@@ -229,11 +1515,7 @@ def init_db():
         ("artificial sweetener", 15),
         ("monosodium glutamate", 10)
     ]
-    for ing, w in seed_harmful:
-        try:
-            cur.execute("INSERT INTO harmful_ingredients (ingredient, weight) VALUES (?, ?)", (ing, w))
-        except Exception:
-            pass
+    conn.executemany("INSERT OR IGNORE INTO harmful_ingredients (ingredient, weight) VALUES (?, ?)", seed_harmful)
 
     # Predictive rules
     seed_rules = [
@@ -243,72 +1525,907 @@ def init_db():
         ("soy sauce", "gluten"),
         ("cake", "egg")
     ]
-    for fi, pa in seed_rules:
-        cur.execute("INSERT INTO predictive_risks (food_item, possible_allergen) VALUES (?, ?)", (fi, pa))
+    conn.executemany("INSERT OR IGNORE INTO predictive_risks (food_item, possible_allergen) VALUES (?, ?)", seed_rules)
+
+    # Demo products (analysed lazily on first scan)
+    seed_products = [
+        ("8901234567890", "Chocolate Bar", "Milk, Sugar, Cocoa, Peanut oil"),
+        ("8909876543210", "Oat Milk", "Water, Oats, Salt"),
+        ("8901111111111", "Plain Water", "")  # no ingredients listed
+    ]
+    conn.executemany("INSERT OR IGNORE INTO products (barcode, name, ingredients) VALUES (?, ?, ?)", seed_products)
 
     # Sample hospital
+    conn.execute("INSERT OR IGNORE INTO hospitals (name, pincode, address, phone) VALUES (?, ?, ?, ?)",
+                 ("City General Hospital", "700091", "MG Road, Kolkata", "+91-33-12345678"))
+
+def _migration_scan_text_blobs(conn):
+    # Move inline OCR text into text_blobs
+    _register_backfill(conn, "scan_text_blobs")
+
+def _migration_scan_detections(conn):
+    # Fill scan_detections for history recorded before it existed
+    _register_backfill(conn, "scan_detections")
+
+def _migration_feedback_counts(conn):
+    # Build the feedback aggregates from existing feedback
+    _register_backfill(conn, "feedback_counts")
+
+def _migration_ruleset_version(conn):
+    # Detection ruleset each scan was evaluated with (NULL = unknown, re-evaluate)
+    if not _column_exists(conn, "scan_history", "ruleset_version"):
+        conn.execute("ALTER TABLE scan_history ADD COLUMN ruleset_version TEXT")
+
+def _migration_allergy_mask(conn):
+    # users.allergy_mask mirrors the allergies JSON as an ALLERGEN_BITS bitmask
+    if not _column_exists(conn, "users", "allergy_mask"):
+        conn.execute("ALTER TABLE users ADD COLUMN allergy_mask INTEGER NOT NULL DEFAULT 0")
+    _register_backfill(conn, "allergy_mask")
+
+def _migration_double_precision_times(conn):
+    # Unix-time columns were created as float4 on PostgreSQL before _pg_sql
+    # mapped REAL to DOUBLE PRECISION; SQLite's REAL is already 8 bytes
+    if DB_BACKEND != "postgres":
+        return
+    for table, column in (("ocr_jobs", "created"), ("ocr_jobs", "deadline"),
+                          ("ocr_cache", "last_used"), ("products", "updated")):
+        conn.execute(f"ALTER TABLE {table} ALTER COLUMN {column} TYPE DOUBLE PRECISION")
+
+def _migration_product_ruleset_version(conn):
+    # Detection ruleset a product's stored analysis came from (NULL = analyse on next lookup)
+    if not _column_exists(conn, "products", "ruleset_version"):
+        conn.execute("ALTER TABLE products ADD COLUMN ruleset_version TEXT")
+
+MIGRATIONS = [
+    _migration_base_schema,
+    _migration_dedupe_reference,
+    _migration_seed,
+    _migration_scan_text_blobs,
+    _migration_scan_detections,
+    _migration_feedback_counts,
+    _migration_ruleset_version,
+    _migration_allergy_mask,
+    _migration_double_precision_times,
+    _migration_product_ruleset_version,
+]
+
+def _ensure_version_table(conn):
+    # PostgreSQL keeps the version in a table. Created (and committed) before
+    # the migration lock is taken: a commit would release the advisory lock.
+    if DB_BACKEND != "postgres":
+        return
     try:
-        cur.execute("INSERT INTO hospitals (name, pincode, address, phone) VALUES (?, ?, ?, ?)",
-                    ("City General Hospital", "700091", "MG Road, Kolkata", "+91-33-12345678"))
-    except Exception:
-        pass
+        conn.execute("CREATE TABLE IF NOT EXISTS schema_migrations (version INTEGER NOT NULL)")
+        conn.commit()
+    except DB_INTEGRITY_ERRORS:
+        # a concurrent worker created it first
+        conn.rollback()
+
+def _schema_version(conn):
+    # Read-only, so it is safe to call while holding the migration lock
+    if DB_BACKEND == "postgres":
+        return conn.execute("SELECT COALESCE(MAX(version), 0) FROM schema_migrations").fetchone()[0]
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+def _set_schema_version(conn, version):
+    if DB_BACKEND == "postgres":
+        conn.execute("DELETE FROM schema_migrations")
+        conn.execute("INSERT INTO schema_migrations (version) VALUES (?)", (version,))
+    else:
+        conn.execute(f"PRAGMA user_version = {int(version)}")
+
+def _begin_migration(conn):
+    # Take the database-wide migration lock for the current transaction
+    if DB_BACKEND == "postgres":
+        conn.execute("SELECT pg_advisory_xact_lock(?)", (MIGRATION_LOCK_ID,))
+        return
+    deadline = time.monotonic() + MIGRATION_LOCK_TIMEOUT
+    while True:
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            return
+        except sqlite3.OperationalError:
+            # another worker is migrating; sqlite already waited DB_BUSY_TIMEOUT
+            if time.monotonic() > deadline:
+                raise
 
-    conn.commit()
-    conn.close()
+def init_db():
+    """Apply pending migrations; returns the schema version."""
+    with db_connection() as conn:
+        _ensure_version_table(conn)
+        if _schema_version(conn) >= len(MIGRATIONS):
+            return len(MIGRATIONS)
+        _begin_migration(conn)
+        try:
+            # re-read under the lock: another worker may have finished meanwhile
+            for migration in MIGRATIONS[_schema_version(conn):]:
+                migration(conn)
+            _set_schema_version(conn, len(MIGRATIONS))
+            conn.commit()
+            pending = pending_backfills(conn)
+        except Exception:
+            conn.rollback()
+            raise
+    if pending:
+        app.logger.warning("data backfills pending (%s); run `flask backfill`", ", ".join(pending))
+    return len(MIGRATIONS)
 
 
 init_db()
 
+# ---------------- reference data cache ----------------
+# harmful_ingredients, predictive_risks and safe_alternatives are small and
+# rarely written, so each process keeps them in memory with the matchers
+# already compiled. Writes through the helpers below bump the version; the
+# TTL bounds staleness for rows written by other processes.
+REFERENCE_CACHE_TTL = float(os.environ.get('REFERENCE_CACHE_TTL', '300'))
+
+_reference_cache = {"version": 0, "data": None}
+
+def invalidate_reference_cache():
+    _reference_cache["version"] += 1
+
+def get_reference_data():
+    cached = _reference_cache["data"]
+    if (cached is not None and cached["version"] == _reference_cache["version"]
+            and time.monotonic() - cached["loaded_at"] < REFERENCE_CACHE_TTL):
+        return cached
+
+    version = _reference_cache["version"]
+    with db_connection() as conn:
+        harmful_rows = conn.execute("SELECT ingredient, weight FROM harmful_ingredients").fetchall()
+        rule_rows = conn.execute("SELECT food_item, possible_allergen FROM predictive_risks").fetchall()
+        alt_rows = conn.execute("SELECT allergen, alternative FROM safe_alternatives").fetchall()
+
+    harmful = [(r['ingredient'].lower(), int(r['weight'])) for r in harmful_rows]
+    predictive = {}
+    for r in rule_rows:
+        predictive.setdefault(r['food_item'].lower(), set()).add(r['possible_allergen'])
+    alternatives = {}
+    for r in alt_rows:
+        alternatives.setdefault(r['allergen'], []).append(r['alternative'])
+
+    data = {
+        "version": version,
+        "loaded_at": time.monotonic(),
+        "harmful": harmful,
+        "health_scorer": HealthScorer(harmful),
+        "predictive": predictive,
+        "predictive_match": compile_phrase_matcher(predictive),
+        "alternatives": alternatives,
+    }
+    _reference_cache["data"] = data
+    return data
+
+def add_safe_alternative(allergen, alternative):
+    with db_connection() as conn:
+        conn.execute("INSERT OR IGNORE INTO safe_alternatives (allergen, alternative) VALUES (?, ?)", (allergen, alternative))
+        conn.commit()
+    invalidate_reference_cache()
+
+def add_harmful_ingredient(ingredient, weight):
+    with db_connection() as conn:
+        conn.execute("INSERT INTO harmful_ingredients (ingredient, weight) VALUES (?, ?)", (ingredient, weight))
+        conn.commit()
+    invalidate_reference_cache()
+
+def add_predictive_risk(food_item, possible_allergen):
+    with db_connection() as conn:
+        conn.execute("INSERT OR IGNORE INTO predictive_risks (food_item, possible_allergen) VALUES (?, ?)", (food_item, possible_allergen))
+        conn.commit()
+    invalidate_reference_cache()
+
 def get_safe_alternatives(allergen):
-    conn = get_db_connection()
-    cur = conn.execute("SELECT alternative FROM safe_alternatives WHERE allergen = ?", (allergen.lower(),))
-    rows = cur.fetchall()
-    conn.close()
-    return [r['alternative'] for r in rows]
+    return list(get_reference_data()["alternatives"].get(allergen.lower(), []))
+
+# ---------------- health scoring ----------------
+# The harmful_ingredients table is compiled into an index of token sequences
+# keyed by first token. Text is tokenized once and only phrases starting with
+# a token that actually occurs are compared, so matching is on whole words
+# ("sugar" does not hit "sugarcane") and cost does not grow with the table.
+# Plurals of the last word ("sugars", "trans fats") are indexed as well.
+_SCORE_TOKEN_RE = re.compile(r"[a-z0-9]+")
+_E_NUMBER_RE = re.compile(r"\be[\s\-](\d{3,4}[a-z]?)\b")
+_E_NUMBER_HINT_RE = re.compile(r"e[\s\-]\d")  # cheap prefilter, no \b scan
+
+def tokenize_ingredients(text):
+    # "E-211", "E 211" and "e211" all become the single token "e211"
+    text = (text or "").lower()
+    if _E_NUMBER_HINT_RE.search(text):
+        text = _E_NUMBER_RE.sub(r"e\1", text)
+    return _SCORE_TOKEN_RE.findall(text)
+
+class HealthScorer:
+    """Compiled (ingredient, weight) table; score()/score_many() return {score, found}."""
+
+    def __init__(self, weighted):
+        self.entries = []   # (ingredient, weight) in table order
+        self.weights = []
+        by_tokens = {}
+        for ing, weight in weighted:
+            tokens = tuple(tokenize_ingredients(ing))
+            if not tokens:
+                continue
+            for last in (tokens[-1], tokens[-1] + "s", tokens[-1] + "es"):
+                by_tokens.setdefault(tokens[:-1] + (last,), []).append(len(self.entries))
+            self.entries.append((ing, int(weight)))
+            self.weights.append(int(weight))
+        self._index = {}    # first token -> [(" tok1 tok2 " or None for one word, entry positions)]
+        for tokens, positions in by_tokens.items():
+            padded = " " + " ".join(tokens) + " " if len(tokens) > 1 else None
+            self._index.setdefault(tokens[0], []).append((padded, positions))
+
+    def matches(self, text):
+        """Positions of the entries whose phrase occurs as a whole-word sequence in text."""
+        tokens = tokenize_ingredients(text)
+        index = self._index
+        hits = set()
+        joined = None
+        for tok in index.keys() & set(tokens):
+            for padded, positions in index[tok]:
+                if padded is not None:
+                    # multi-word phrase: compare against the token stream, still on word boundaries
+                    if joined is None:
+                        joined = " " + " ".join(tokens) + " "
+                    if padded not in joined:
+                        continue
+                hits.update(positions)
+        return hits
+
+    def _result(self, hits, penalty):
+        return {"score": max(0, 100 - penalty), "found": [self.entries[p] for p in sorted(hits)]}
+
+    def score(self, text):
+        hits = self.matches(text)
+        return self._result(hits, sum(self.weights[p] for p in hits))
+
+    def score_many(self, texts):
+        return [self.score(t) for t in texts]
 
 def compute_health_score(ingredients_text):
     # returns dict {score: int, found: [(ingredient, weight), ...]}
-    conn = get_db_connection()
-    cur = conn.execute("SELECT ingredient, weight FROM harmful_ingredients")
-    rows = cur.fetchall()
-    conn.close()
-    text = (ingredients_text or "").lower()
-    score = 100
-    found = []
-    for r in rows:
-        ing = r['ingredient'].lower()
-        if ing in text:
-            score -= int(r['weight'])
-            found.append((ing, int(r['weight'])))
-    score = max(0, score)
-    return {"score": score, "found": found}
+    return get_reference_data()["health_scorer"].score(ingredients_text)
+
+def compute_health_scores(texts):
+    """compute_health_score for many texts at once (same result shape, same order)."""
+    return get_reference_data()["health_scorer"].score_many(texts)
 
 def get_predictive_allergens_from_text(text):
     # checks predictive_risks.food_item presence in OCR text
-    conn = get_db_connection()
-    cur = conn.execute("SELECT food_item, possible_allergen FROM predictive_risks")
-    rows = cur.fetchall()
-    conn.close()
-    text_lower = (text or "").lower()
+    ref = get_reference_data()
     preds = set()
-    for r in rows:
-        if r['food_item'].lower() in text_lower:
-            preds.add(r['possible_allergen'])
+    for food_item in ref["predictive_match"]((text or "").lower()):
+        preds |= ref["predictive"][food_item]
     return list(preds)
 
+# ---------------- product catalog ----------------
+PRODUCT_CACHE_SIZE = int(os.environ.get('PRODUCT_CACHE_SIZE', '4096'))
+PRODUCT_CACHE_TTL = float(os.environ.get('PRODUCT_CACHE_TTL', '600'))
+PRODUCT_IMPORT_CHUNK = int(os.environ.get('PRODUCT_IMPORT_CHUNK', '1000'))
+
+_product_cache = TTLCache(PRODUCT_CACHE_SIZE, PRODUCT_CACHE_TTL)
+
+def analyse_product_text(ingredients):
+    # Columns stored alongside a product so barcode scans skip the text pipeline
+    # (detections, health_score, predictive_allergens, ruleset_version)
+    ingredients = ingredients or ""
+    detections = detect_allergens_from_text(ingredients)
+    return (
+        json.dumps(detections),
+        compute_health_score(ingredients)["score"],
+        json.dumps(get_predictive_allergens_from_text(ingredients)),
+        RULESET_VERSION if detections.complete else None,
+    )
+
+def get_product_by_barcode(barcode):
+    product = _product_cache.get(barcode)
+    if product is not TTLCache.MISSING:
+        return product
+
+    with db_connection() as conn:
+        row = conn.execute("SELECT * FROM products WHERE barcode = ?", (barcode,)).fetchone()
+        if (row and (row['ingredients'] or '').strip()
+                and (row['detections'] is None or row['ruleset_version'] != RULESET_VERSION)):
+            # Seeded rows, or analysed under an older ruleset: (re)analyse and keep the result
+            conn.execute("UPDATE products SET detections = ?, health_score = ?, predictive_allergens = ?, ruleset_version = ?, "
+                         "updated = ? WHERE barcode = ?",
+                         analyse_product_text(row['ingredients']) + (time.time(), barcode))
+            conn.commit()
+            row = conn.execute("SELECT * FROM products WHERE barcode = ?", (barcode,)).fetchone()
+
+    product = None
+    if row:
+        product = {
+            "barcode": row['barcode'],
+            "name": row['name'],
+            "ingredients": row['ingredients'] or "",
+            "detections": json.loads(row['detections']) if row['detections'] else [],
+            "health_score": row['health_score'],
+            "predictive_allergens": json.loads(row['predictive_allergens']) if row['predictive_allergens'] else [],
+            "updated": row['updated'],
+        }
+        # Misses aren't cached: a product imported by another process must show up at once
+        _product_cache.put(barcode, product)
+    return product
+
+def get_users_affected_by(mask, limit=None):
+    """Users whose allergy profile overlaps an ALLERGEN_BITS mask, with the overlapping allergens."""
+    sql = "SELECT id, username, allergy_mask FROM users WHERE (allergy_mask & ?) != 0 ORDER BY id"
+    params = [mask]
+    if limit:
+        sql += " LIMIT ?"
+        params.append(limit)
+    with db_connection() as conn:
+        rows = conn.execute(sql, params).fetchall()
+    return [{"id": r['id'], "username": r['username'], "allergens": mask_to_allergens(r['allergy_mask'] & mask)}
+            for r in rows]
+
+def get_users_affected_by_product(barcode, severities=("high",), limit=None):
+    # None for an unknown barcode
+    product = get_product_by_barcode(barcode)
+    if product is None:
+        return None
+    mask = allergen_mask(d['allergen'] for d in product['detections'] if d['severity'] in severities)
+    return get_users_affected_by(mask, limit) if mask else []
+
+def _iter_product_records(path):
+    """
+    Stream (barcode, name, ingredients) from an OpenFoodFacts-style dump:
+    JSON lines (.jsonl/.ndjson) or CSV/TSV (delimiter sniffed from the header),
+    optionally gzip-compressed. Only one line is held in memory at a time.
+    """
+    opener = gzip.open if path.endswith('.gz') else open
+    base = path[:-3] if path.endswith('.gz') else path
+    with opener(path, 'rt', encoding='utf-8', newline='') as fh:
+        if base.endswith(('.jsonl', '.ndjson', '.json')):
+            for line in fh:
+                if not line.strip():
+                    continue
+                rec = json.loads(line)
+                yield (str(rec.get('code') or rec.get('barcode') or ''),
+                       rec.get('product_name') or rec.get('name'),
+                       rec.get('ingredients_text') or rec.get('ingredients') or '')
+        else:
+            header = fh.readline()
+            fields = next(csv.reader([header], delimiter='\t' if '\t' in header else ','))
+            reader = csv.DictReader(fh, fieldnames=fields, delimiter='\t' if '\t' in header else ',')
+            for rec in reader:
+                yield (str(rec.get('code') or rec.get('barcode') or ''),
+                       rec.get('product_name') or rec.get('name'),
+                       rec.get('ingredients_text') or rec.get('ingredients') or '')
+
+def import_products(path, chunk_size=PRODUCT_IMPORT_CHUNK, progress=None):
+    """
+    Bulk-load a product dump into the products table in chunked transactions,
+    precomputing the allergen analysis for each row. Returns rows imported.
+    """
+    csv.field_size_limit(16 * 1024 * 1024)
+    sql = ("INSERT OR REPLACE INTO products (barcode, name, ingredients, detections, health_score, predictive_allergens, "
+           "ruleset_version, updated) VALUES (?, ?, ?, ?, ?, ?, ?, ?)")
+    with db_connection() as conn:
+        total = 0
+        chunk = []
+        for barcode, name, ingredients in _iter_product_records(path):
+            if not barcode:
+                continue
+            chunk.append((barcode, name, ingredients) + analyse_product_text(ingredients) + (time.time(),))
+            if len(chunk) >= chunk_size:
+                conn.executemany(sql, chunk)
+                conn.commit()
+                total += len(chunk)
+                chunk = []
+                if progress:
+                    progress(total)
+        if chunk:
+            conn.executemany(sql, chunk)
+            conn.commit()
+            total += len(chunk)
+    _product_cache.clear()
+    return total
+
+@app.cli.command('import-products')
+@click.argument('path')
+@click.option('--chunk-size', default=PRODUCT_IMPORT_CHUNK, show_default=True, help='Rows per transaction.')
+def import_products_command(path, chunk_size):
+    """Import an OpenFoodFacts-style CSV/TSV/JSONL dump (optionally .gz) into products."""
+    total = import_products(path, chunk_size, progress=lambda n: click.echo(f"... {n} rows"))
+    click.echo(f"Imported {total} products.")
+
+def rescore_products(chunk_size=PRODUCT_IMPORT_CHUNK, progress=None):
+    """
+    Recompute health_score for the whole catalog (e.g. after editing
+    harmful_ingredients), walking products by barcode in chunks and scoring
+    each chunk in one batch. Returns the number of rows rescored.
+    """
+    with db_connection() as conn:
+        total = 0
+        last = ""
+        while True:
+            rows = conn.execute("SELECT barcode, ingredients FROM products WHERE barcode > ? ORDER BY barcode LIMIT ?",
+                                (last, chunk_size)).fetchall()
+            if not rows:
+                break
+            scores = compute_health_scores([r['ingredients'] or "" for r in rows])
+            now = time.time()
+            conn.executemany("UPDATE products SET health_score = ?, updated = ? WHERE barcode = ?",
+                             [(sc["score"], now, r['barcode']) for r, sc in zip(rows, scores)])
+            conn.commit()
+            total += len(rows)
+            last = rows[-1]['barcode']
+            if progress:
+                progress(total)
+    _product_cache.clear()
+    return total
+
+@app.cli.command('rescore-products')
+@click.option('--chunk-size', default=PRODUCT_IMPORT_CHUNK, show_default=True, help='Rows per transaction.')
+def rescore_products_command(chunk_size):
+    """Recompute product health scores against the current harmful_ingredients table."""
+    total = rescore_products(chunk_size, progress=lambda n: click.echo(f"... {n} rows"))
+    click.echo(f"Rescored {total} products.")
+
+@app.cli.command('affected-users')
+@click.argument('barcode')
+@click.option('--include-traces', is_flag=True, help='Also count "may contain" (medium) detections.')
+def affected_users_command(barcode, include_traces):
+    """List users whose allergies match a product's detected allergens."""
+    users = get_users_affected_by_product(barcode, ("high", "medium") if include_traces else ("high",))
+    if users is None:
+        raise click.ClickException(f"Unknown barcode {barcode}")
+    for u in users:
+        click.echo(f"{u['username']}: {', '.join(u['allergens'])}")
+    click.echo(f"{len(users)} users affected.")
+
+def _utc_timestamp():
+    # Same format as SQLite CURRENT_TIMESTAMP
+    return datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+def _insert_feedback(conn, username, product_name, reaction, notes="", timestamp=None):
+    conn.execute("INSERT INTO feedback (username, product_name, reaction, notes, timestamp) VALUES (?, ?, ?, ?, ?)",
+                 (username, product_name, reaction, notes, timestamp or _utc_timestamp()))
+    # Keep the community aggregates in step, in the same transaction
+    conn.execute("INSERT INTO feedback_product_counts (product_name, cnt) VALUES (?, 1) "
+                 "ON CONFLICT (product_name) DO UPDATE SET cnt = feedback_product_counts.cnt + 1",
+                 (product_name or '',))
+    conn.execute("INSERT INTO feedback_reaction_counts (product_name, reaction, cnt) VALUES (?, ?, 1) "
+                 "ON CONFLICT (product_name, reaction) DO UPDATE SET cnt = feedback_reaction_counts.cnt + 1",
+                 (product_name or '', reaction or ''))
+
+# ---------------- write-behind persistence ----------------
+# With WRITE_BEHIND=1, scan history and feedback inserts are queued and
+# committed in batches by a background thread (every WRITE_BEHIND_INTERVAL
+# seconds or WRITE_BEHIND_BATCH items), so requests never wait on a commit.
+# When the queue is full the write falls back to the synchronous path.
+WRITE_BEHIND = os.environ.get('WRITE_BEHIND', '0') == '1'
+WRITE_BEHIND_QUEUE_SIZE = int(os.environ.get('WRITE_BEHIND_QUEUE_SIZE', '1000'))
+WRITE_BEHIND_BATCH = int(os.environ.get('WRITE_BEHIND_BATCH', '100'))
+WRITE_BEHIND_INTERVAL = float(os.environ.get('WRITE_BEHIND_INTERVAL', '0.5'))
+
+_write_queue = queue.Queue(maxsize=WRITE_BEHIND_QUEUE_SIZE)
+_writer = {}
+write_behind_stats = {"queued": 0, "written": 0, "batches": 0, "fallback_sync": 0, "failed": 0}
+
+def _write_feedback_rows(conn, rows):
+    for row in rows:
+        _insert_feedback(conn, *row)
+    _community_cache.clear()
+
+def _write_scan_history_rows(conn, rows):
+    for row in rows:
+        _insert_scan_history(conn, *row)
+
+WRITE_BEHIND_HANDLERS = {"feedback": _write_feedback_rows, "scan_history": _write_scan_history_rows}
+
+def _flush_write_batch(batch):
+    with db_connection() as conn:
+        try:
+            for kind, rows in batch:
+                WRITE_BEHIND_HANDLERS[kind](conn, rows)
+            conn.commit()
+            write_behind_stats["batches"] += 1
+            write_behind_stats["written"] += len(batch)
+        except Exception:
+            # One bad item must not sink the whole batch: retry items one by one
+            conn.rollback()
+            for kind, rows in batch:
+                try:
+                    WRITE_BEHIND_HANDLERS[kind](conn, rows)
+                    conn.commit()
+                    write_behind_stats["written"] += 1
+                except Exception:
+                    conn.rollback()
+                    write_behind_stats["failed"] += 1
+                    app.logger.exception("write-behind %s insert failed", kind)
+
+def _write_behind_loop():
+    while True:
+        batch = [_write_queue.get()]
+        flush_at = time.monotonic() + WRITE_BEHIND_INTERVAL
+        while len(batch) < WRITE_BEHIND_BATCH:
+            remaining = flush_at - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(_write_queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        try:
+            _flush_write_batch(batch)
+        finally:
+            for _ in batch:
+                _write_queue.task_done()
+
+def _queue_write(kind, rows):
+    """Hand rows to the background writer; False means the caller must write synchronously."""
+    if not WRITE_BEHIND:
+        return False
+    if _writer.get('pid') != os.getpid() or not _writer['thread'].is_alive():
+        _writer['thread'] = threading.Thread(target=_write_behind_loop, name='write-behind', daemon=True)
+        _writer['thread'].start()
+        _writer['pid'] = os.getpid()
+    try:
+        _write_queue.put_nowait((kind, rows))
+    except queue.Full:
+        write_behind_stats["fallback_sync"] += 1
+        return False
+    write_behind_stats["queued"] += 1
+    return True
+
+def write_queue_depth():
+    return _write_queue.qsize()
+
+def flush_write_behind(timeout=10.0):
+    """Wait (up to timeout seconds) until every queued write is committed."""
+    give_up = time.monotonic() + timeout
+    while _write_queue.unfinished_tasks and time.monotonic() < give_up:
+        if not (_writer.get('thread') and _writer['thread'].is_alive() and _writer.get('pid') == os.getpid()):
+            break
+        time.sleep(0.01)
+    return _write_queue.unfinished_tasks == 0
+
+atexit.register(flush_write_behind)
+
 def add_feedback(username, product_name, reaction, notes=""):
-    conn = get_db_connection()
-    conn.execute("INSERT INTO feedback (username, product_name, reaction, notes) VALUES (?, ?, ?, ?)",
-                 (username, product_name, reaction, notes))
+    row = (username, product_name, reaction, notes, _utc_timestamp())
+    if _queue_write("feedback", [row]):
+        return
+    with db_connection() as conn:
+        _write_feedback_rows(conn, [row])
+        conn.commit()
+
+# Top reported products are shared by every viewer, so cache them briefly
+COMMUNITY_CACHE_TTL = float(os.environ.get('COMMUNITY_CACHE_TTL', '30'))
+_community_cache = TTLCache(8, COMMUNITY_CACHE_TTL)
+
+def get_feedback_version():
+    """(highest feedback id, newest feedback timestamp); changes whenever feedback is written."""
+    with db_connection() as conn:
+        row = conn.execute("SELECT (SELECT MAX(id) FROM feedback), (SELECT MAX(timestamp) FROM feedback)").fetchone()
+    return (row[0] or 0), row[1]
+
+def get_top_reported_products(limit=100, version=None):
+    """
+    Most reported products with their per-reaction breakdown, read from the
+    incrementally maintained count tables: [{product_name, cnt, reactions}].
+    Passing a get_feedback_version() id skips entries cached before it.
+    """
+    cached = _community_cache.get((limit, version))
+    if cached is not TTLCache.MISSING:
+        return cached
+
+    with db_connection() as conn:
+        products = [dict(r, reactions={}) for r in conn.execute(
+            "SELECT product_name, cnt FROM feedback_product_counts ORDER BY cnt DESC LIMIT ?", (limit,)).fetchall()]
+        if products:
+            by_name = {p['product_name']: p for p in products}
+            placeholders = ",".join("?" * len(by_name))
+            for r in conn.execute(f"SELECT product_name, reaction, cnt FROM feedback_reaction_counts "
+                                  f"WHERE product_name IN ({placeholders}) ORDER BY cnt DESC", list(by_name)).fetchall():
+                by_name[r['product_name']]['reactions'][r['reaction']] = r['cnt']
+
+    _community_cache.put((limit, version), products)
+    return products
+
+def _insert_scan_history(conn, username, product_name, ingredients, detected_allergens, detections=None, timestamp=None):
+    # Explicit UTC timestamp shared with scan_detections (taken at request time for queued writes)
+    timestamp = timestamp or _utc_timestamp()
+    text_hash = store_text_blob(conn, ingredients) if ingredients is not None else None
+    scan_id = _insert_returning_id(
+        conn,
+        "INSERT INTO scan_history (username, product_name, ingredients_hash, detected_allergens, timestamp, ruleset_version) "
+        "VALUES (?, ?, ?, ?, ?, ?)",
+        (username, product_name, text_hash, ",".join(detected_allergens), timestamp,
+         RULESET_VERSION if detections is not None and getattr(detections, 'complete', True) else None))
+    if detections is None:
+        detections = [{"allergen": a, "severity": None, "matched": None} for a in detected_allergens]
+    _insert_scan_detections(conn, scan_id, username, timestamp, detections)
+    return scan_id
+
+def save_scan_history(username, product_name, ingredients, detected_allergens, detections=None):
+    # Returns the new scan id, or None when the insert was queued (WRITE_BEHIND)
+    row = (username, product_name, ingredients, detected_allergens, detections, _utc_timestamp())
+    if _queue_write("scan_history", [row]):
+        return None
+    with db_connection() as conn:
+        scan_id = _insert_scan_history(conn, *row)
+        conn.commit()
+    return scan_id
+
+def save_scan_history_many(rows):
+    # rows: iterable of (username, product_name, ingredients, detected_allergens, detections); one transaction
+    timestamp = _utc_timestamp()
+    rows = [tuple(row) + (timestamp,) for row in rows]
+    if _queue_write("scan_history", rows):
+        return
+    with db_connection() as conn:
+        _write_scan_history_rows(conn, rows)
+        conn.commit()
+
+def get_detections_for_scans(scan_ids):
+    """Map scan_history.id -> list of detection dicts from scan_detections."""
+    scan_ids = list(scan_ids)
+    result = {scan_id: [] for scan_id in scan_ids}
+    if not scan_ids:
+        return result
+    with db_connection() as conn:
+        placeholders = ",".join("?" * len(scan_ids))
+        rows = conn.execute(f"SELECT scan_id, allergen, severity, matched FROM scan_detections WHERE scan_id IN ({placeholders})",
+                            scan_ids).fetchall()
+    for r in rows:
+        result[r['scan_id']].append({"allergen": r['allergen'], "severity": r['severity'], "matched": r['matched']})
+    return result
+
+def count_scans_by_allergen(allergen, since=None, severity=None):
+    """Number of scans that detected `allergen` (optionally since a 'YYYY-MM-DD HH:MM:SS' timestamp)."""
+    sql = "SELECT COUNT(DISTINCT scan_id) FROM scan_detections WHERE allergen = ?"
+    params = [allergen]
+    if since:
+        sql += " AND timestamp >= ?"
+        params.append(since)
+    if severity:
+        sql += " AND severity = ?"
+        params.append(severity)
+    with db_connection() as conn:
+        count = conn.execute(sql, params).fetchone()[0]
+    return count
+
+def get_allergen_counts_by_user(username, since=None):
+    """{allergen: number of scans} for one user, most frequent first."""
+    sql = "SELECT allergen, COUNT(DISTINCT scan_id) AS cnt FROM scan_detections WHERE username = ?"
+    params = [username]
+    if since:
+        sql += " AND timestamp >= ?"
+        params.append(since)
+    sql += " GROUP BY allergen ORDER BY cnt DESC"
+    with db_connection() as conn:
+        rows = conn.execute(sql, params).fetchall()
+    return {r['allergen']: r['cnt'] for r in rows}
+
+# ---------------- data export ----------------
+# A user's scans and feedback are walked newest-first in keyset pages of
+# EXPORT_BATCH rows and encoded as they go, so memory stays flat no matter
+# how many rows the user has.
+EXPORT_BATCH = int(os.environ.get('EXPORT_BATCH', '500'))
+EXPORT_KINDS = ("history", "feedback", "all")
+EXPORT_FORMATS = ("csv", "ndjson")
+EXPORT_FIELDS = {
+    "history": ["id", "timestamp", "product_name", "detected_allergens", "detections", "ingredients"],
+    "feedback": ["id", "timestamp", "product_name", "reaction", "notes"],
+}
+
+def _iter_keyset(table, username, columns="*", batch_size=EXPORT_BATCH):
+    # Yield pages (lists of rows) of one user's rows, newest first
+    before = None
+    while True:
+        with db_connection() as conn:
+            rows = conn.execute(*_keyset_query(table, [("username", username)], before, batch_size, columns)).fetchall()
+        if not rows:
+            return
+        yield rows
+        if len(rows) < batch_size:
+            return
+        before = (rows[-1]['timestamp'], rows[-1]['id'])
+
+def iter_user_records(username, kind="all", batch_size=EXPORT_BATCH):
+    """Yield (record type, dict) for a user's scan history and/or feedback."""
+    if kind in ("history", "all"):
+        for rows in _iter_keyset("scan_history", username, SCAN_HISTORY_LIST_COLUMNS + ", ingredients", batch_size):
+            with db_connection() as conn:
+                texts = load_text_blobs(conn, [r['ingredients_hash'] for r in rows])
+            detections = get_detections_for_scans(r['id'] for r in rows)
+            for r in rows:
+                yield "history", {
+                    "id": r['id'],
+                    "timestamp": r['timestamp'],
+                    "product_name": r['product_name'],
+                    "detected_allergens": [a for a in (r['detected_allergens'] or '').split(',') if a],
+                    "detections": detections[r['id']],
+                    "ingredients": texts.get(r['ingredients_hash'], '') if r['ingredients_hash'] else (r['ingredients'] or ''),
+                }
+    if kind in ("feedback", "all"):
+        for rows in _iter_keyset("feedback", username, batch_size=batch_size):
+            for r in rows:
+                yield "feedback", {field: r[field] for field in EXPORT_FIELDS["feedback"]}
+
+def export_user_data(username, kind="all", fmt="ndjson", compress=False, chunk_bytes=64 * 1024):
+    """
+    Generate a user's export as byte chunks: NDJSON (one object per line,
+    tagged with "type") or CSV (a "type" column plus the union of fields),
+    optionally as a gzip stream.
+    """
+    if fmt == "csv":
+        columns = ["type"] + list(dict.fromkeys(
+            field for k in (("history", "feedback") if kind == "all" else (kind,)) for field in EXPORT_FIELDS[k]))
+        buf = StringIO()
+        writer = csv.writer(buf)
+
+        def encode_row(values):
+            writer.writerow(values)
+            line = buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+            return line
+
+        def encode(record_type, record):
+            return encode_row([record_type] + [
+                json.dumps(record[c]) if isinstance(record.get(c), (list, dict)) else record.get(c, '')
+                for c in columns[1:]])
+        header = encode_row(columns)
+    else:
+        def encode(record_type, record):
+            return json.dumps({"type": record_type, **record}, default=str) + "\n"
+        header = ""
+
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None  # wbits=31: gzip container
+    pending = [header]
+    size = len(header)
+    for record_type, record in iter_user_records(username, kind):
+        line = encode(record_type, record)
+        pending.append(line)
+        size += len(line)
+        if size >= chunk_bytes:
+            data = "".join(pending).encode("utf-8")
+            data = compressor.compress(data) if compressor else data
+            if data:
+                yield data
+            pending, size = [], 0
+    data = "".join(pending).encode("utf-8")
+    if compressor:
+        data = compressor.compress(data) + compressor.flush()
+    if data:
+        yield data
+
+@app.cli.command('export-user')
+@click.argument('username')
+@click.option('--kind', type=click.Choice(EXPORT_KINDS), default='all', show_default=True)
+@click.option('--format', 'fmt', type=click.Choice(EXPORT_FORMATS), default='ndjson', show_default=True)
+@click.option('--gzip', 'compress', is_flag=True, help='gzip the output.')
+@click.option('--output', '-o', type=click.Path(dir_okay=False), help='Write to a file instead of stdout.')
+def export_user_command(username, kind, fmt, compress, output):
+    """Stream a user's scan history and/or feedback as CSV or NDJSON."""
+    out = open(output, 'wb') if output else click.get_binary_stream('stdout')
+    try:
+        for chunk in export_user_data(username, kind, fmt, compress):
+            out.write(chunk)
+    finally:
+        if output:
+            out.close()
+
+# ---------------- history re-evaluation ----------------
+# After the detection rules change, stored scans are re-run offline: scan_history
+# is walked by id in chunks of rows whose ruleset_version is not the current one,
+# each chunk's distinct OCR texts are detected in a process pool, and results are
+# written back in one short transaction per chunk so the live app keeps going.
+REEVALUATE_CHUNK = int(os.environ.get('REEVALUATE_CHUNK', '2000'))
+
+def _detect_many(texts):
+    # Pool worker: plain top-level function so it pickles
+    return [detect_allergens_from_text(t) for t in texts]
+
+def _apply_reevaluation(conn, rows, texts, detections_by_text, allergy_masks, stats):
+    usernames = {r['username'] for r in rows if r['username'] not in allergy_masks}
+    if usernames:
+        placeholders = ",".join("?" * len(usernames))
+        for u in conn.execute(f"SELECT username, allergy_mask FROM users WHERE username IN ({placeholders})",
+                              list(usernames)).fetchall():
+            allergy_masks[u['username']] = u['allergy_mask']
+        for username in usernames:
+            allergy_masks.setdefault(username, 0)
+
+    history_updates, detection_rows = [], []
+    for r in rows:
+        detections = detections_by_text[_scan_row_text(r, texts)]
+        ruleset_version = RULESET_VERSION if detections.complete else None
+        stored = {a for a in (r['detected_allergens'] or '').split(',') if a}
+        found = {d['allergen'] for d in detections}
+        # Like the backfill, never drop an allergen a scan was already flagged for
+        detections = detections + [{"allergen": a, "severity": None, "matched": None} for a in sorted(stored - found)]
+        if found - stored:
+            stats["changed"] += 1
+            if allergen_mask(found - stored) & allergy_masks[r['username']]:
+                stats["newly_flagged"] += 1
+                stats["users"][r['username']] = stats["users"].get(r['username'], 0) + 1
+        history_updates.append((",".join(sorted(stored | found)), ruleset_version, r['id']))
+        detection_rows.append((r, detections))
+
+    ids = [r['id'] for r in rows]
+    conn.execute(f"DELETE FROM scan_detections WHERE scan_id IN ({','.join('?' * len(ids))})", ids)
+    for r, detections in detection_rows:
+        _insert_scan_detections(conn, r['id'], r['username'], r['timestamp'], detections)
+    conn.executemany("UPDATE scan_history SET detected_allergens = ?, ruleset_version = ? WHERE id = ?", history_updates)
     conn.commit()
-    conn.close()
+    stats["scanned"] += len(rows)
+
+def _scan_row_text(row, texts):
+    return texts.get(row['ingredients_hash'], '') if row['ingredients_hash'] else (row['ingredients'] or '')
 
-def save_scan_history(username, product_name, ingredients, detected_allergens):
+def reevaluate_scan_history(workers=None, chunk_size=REEVALUATE_CHUNK, progress=None):
+    """
+    Re-run allergen detection for scans evaluated under an older ruleset.
+    Returns counts: total stale rows, scanned, changed (gained an allergen),
+    newly_flagged (gained one of the user's own allergens) and per-user
+    newly flagged counts under "users". `progress(stats)` runs after each chunk.
+    """
+    workers = workers or os.cpu_count() or 1
     conn = get_db_connection()
-    conn.execute("INSERT INTO scan_history (username, product_name, ingredients, detected_allergens) VALUES (?, ?, ?, ?)",
-                 (username, product_name, ingredients, ",".join(detected_allergens)))
-    conn.commit()
-    conn.close()
+    stale = "ruleset_version IS NULL OR ruleset_version <> ?"
+    total = conn.execute(f"SELECT COUNT(*) FROM scan_history WHERE {stale}", (RULESET_VERSION,)).fetchone()[0]
+    stats = {"total": total, "scanned": 0, "changed": 0, "newly_flagged": 0, "users": {}}
+    allergy_masks = {}
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    in_flight = deque()  # chunks being detected; reading the next chunk overlaps with them
+
+    def finish(chunk):
+        rows, texts, distinct, futures = chunk
+        results = [d for f in futures for d in f.result()] if executor else _detect_many(distinct)
+        _apply_reevaluation(conn, rows, texts, dict(zip(distinct, results)), allergy_masks, stats)
+        if progress:
+            progress(stats)
+
+    try:
+        last_id = 0
+        while True:
+            rows = conn.execute(f"SELECT id, username, ingredients, ingredients_hash, detected_allergens, timestamp "
+                                f"FROM scan_history WHERE id > ? AND ({stale}) ORDER BY id LIMIT ?",
+                                (last_id, RULESET_VERSION, chunk_size)).fetchall()
+            if not rows:
+                break
+            last_id = rows[-1]['id']
+            texts = load_text_blobs(conn, [r['ingredients_hash'] for r in rows])
+            # Scans share texts (content-addressed blobs), so detect each distinct one once
+            distinct = list(dict.fromkeys(_scan_row_text(r, texts) for r in rows))
+            futures = []
+            if executor:
+                step = max(1, -(-len(distinct) // workers))
+                futures = [executor.submit(_detect_many, distinct[i:i + step]) for i in range(0, len(distinct), step)]
+            in_flight.append((rows, texts, distinct, futures))
+            if len(in_flight) > 1:
+                finish(in_flight.popleft())
+        while in_flight:
+            finish(in_flight.popleft())
+    finally:
+        if executor:
+            executor.shutdown(cancel_futures=True)
+        conn.close()
+    return stats
+
+@app.cli.command('reevaluate-history')
+@click.option('--workers', type=int, default=None, help='Detection processes (default: CPU count).')
+@click.option('--chunk-size', default=REEVALUATE_CHUNK, show_default=True, help='Scans per read/write batch.')
+def reevaluate_history_command(workers, chunk_size):
+    """Re-run allergen detection on stored scans evaluated with an older ruleset."""
+    started = time.monotonic()
+
+    def report(stats):
+        rate = stats["scanned"] / max(time.monotonic() - started, 1e-9)
+        click.echo(f"... {stats['scanned']}/{stats['total']} scans, {stats['changed']} changed, "
+                   f"{stats['newly_flagged']} newly flagged ({rate:.0f} scans/s)")
+
+    stats = reevaluate_scan_history(workers, chunk_size, progress=report)
+    click.echo(f"Re-evaluated {stats['scanned']} scans with ruleset {RULESET_VERSION}: {stats['changed']} gained allergens, "
+               f"{stats['newly_flagged']} now match the user's own allergies.")
+    for username, count in sorted(stats["users"].items(), key=lambda kv: -kv[1])[:20]:
+        click.echo(f"  {username}: {count}")
 
 
 # ---------------- auth helpers ----------------
@@ -332,9 +2449,8 @@ def login():
     if request.method == 'POST':
         username = request.form.get('username','').strip()
         password = request.form.get('password','')
-        conn = get_db_connection()
-        user = conn.execute('SELECT * FROM users WHERE username = ?', (username,)).fetchone()
-        conn.close()
+        with db_connection() as conn:
+            user = conn.execute('SELECT * FROM users WHERE username = ?', (username,)).fetchone()
         if user and check_password_hash(user['password_hash'], password):
             session['user_id'] = user['id']
             session['username'] = user['username']
@@ -353,18 +2469,16 @@ def signup():
         selected = request.form.getlist('allergies')  # list of allergen keys
         if not username or not password:
             return render_template('signup.html', error='Username and password required.', allergens=PREDEFINED_ALLERGENS)
-        conn = get_db_connection()
-        try:
-            conn.execute(
-                'INSERT INTO users (username, password_hash, full_name, allergies) VALUES (?,?,?,?)',
-                (username, generate_password_hash(password), full_name, json.dumps(selected))
-            )
-            conn.commit()
-            conn.close()
-            return redirect(url_for('login'))
-        except sqlite3.IntegrityError:
-            conn.close()
-            return render_template('signup.html', error='Username already exists.', allergens=PREDEFINED_ALLERGENS)
+        with db_connection() as conn:
+            try:
+                conn.execute(
+                    'INSERT INTO users (username, password_hash, full_name, allergies, allergy_mask) VALUES (?,?,?,?,?)',
+                    (username, generate_password_hash(password), full_name, json.dumps(selected), allergen_mask(selected))
+                )
+                conn.commit()
+            except DB_INTEGRITY_ERRORS:
+                return render_template('signup.html', error='Username already exists.', allergens=PREDEFINED_ALLERGENS)
+        return redirect(url_for('login'))
     return render_template('signup.html', allergens=PREDEFINED_ALLERGENS)
 
 @app.route('/dashboard')
@@ -373,7 +2487,7 @@ def dashboard():
     user = get_user_by_id(session['user_id'])
 
     # Parse allergies safely
-    user_allergies = json.loads(user['allergies']) if user and user.get('allergies') else []
+    user_allergies = list(user['allergy_list']) if user else []
 
     # Prefer full_name if it exists, else fallback
     if user and user.get('full_name'):
@@ -397,12 +2511,9 @@ def profile():
     user = get_user_by_id(session['user_id'])
     if request.method == 'POST':
         selected = request.form.getlist('allergies')
-        conn = get_db_connection()
-        conn.execute('UPDATE users SET allergies = ? WHERE id = ?', (json.dumps(selected), user['id']))
-        conn.commit()
-        conn.close()
+        update_user_allergies(user['id'], selected)
         return redirect(url_for('dashboard'))
-    user_allergies = json.loads(user['allergies']) if user else []
+    user_allergies = list(user['allergy_list']) if user else []
     return render_template(
     'profile.html',
     user=user,   # add this
@@ -410,40 +2521,206 @@ def profile():
     user_allergies=user_allergies,
     display=DISPLAY_NAME
 )
-@app.route('/scan', methods=['GET','POST'])
-@login_required
-def scan():
-    if request.method == 'GET':
-        return render_template('scan.html', display=DISPLAY_NAME)
-
-    # handle uploaded image
-    file = request.files.get('image')
-    if not file or file.filename == '':
-        return jsonify({'error': 'No image file provided.'}), 400
+# ---------------- OCR pipeline ----------------
+# OCR_MODE=async hands uploads to a bounded process pool and /scan returns a
+# job id; OCR_MODE=sync runs Tesseract inline (simplest for tests/dev).
+OCR_MODE = os.environ.get('OCR_MODE', 'async')
+OCR_WORKERS = int(os.environ.get('OCR_WORKERS', str(min(4, os.cpu_count() or 1))))
+OCR_QUEUE_SIZE = int(os.environ.get('OCR_QUEUE_SIZE', str(OCR_WORKERS * 4)))
+OCR_JOB_TIMEOUT = float(os.environ.get('OCR_JOB_TIMEOUT', '30'))
+OCR_JOB_RETENTION = float(os.environ.get('OCR_JOB_RETENTION', '86400'))
+OCR_CACHE_MEMORY_ITEMS = int(os.environ.get('OCR_CACHE_MEMORY_ITEMS', '256'))
+OCR_CACHE_MAX_BYTES = int(os.environ.get('OCR_CACHE_MAX_BYTES', str(50 * 1024 * 1024)))
+# Near-duplicate reuse returns another upload's OCR text when image_phash
+# matches. That is only safe if the two photos show the same label: an
+# allergy app must never hand back a different product's ingredients, so it
+# stays opt-in and requires identical dimensions plus a 256-bit hash match.
+OCR_CACHE_PHASH = os.environ.get('OCR_CACHE_PHASH', '0') == '1'
+
+# Preprocessing only ever shrinks labels, keeping the aspect ratio: to at most
+# OCR_MAX_EDGE pixels on the long edge, and down to OCR_TARGET_DPI when the
+# file records a real scanning DPI. Phone photos carry a meaningless 72/96 dpi
+# tag, so DPI values below OCR_MIN_DPI are ignored. Small images are passed
+# through as they are; upscaling them is not known to help Tesseract here.
+OCR_TARGET_DPI = int(os.environ.get('OCR_TARGET_DPI', '300'))
+OCR_MIN_DPI = int(os.environ.get('OCR_MIN_DPI', '150'))
+OCR_MAX_EDGE = int(os.environ.get('OCR_MAX_EDGE', '2000'))
+OCR_CROP_TEXT = os.environ.get('OCR_CROP_TEXT', '0') == '1'
+
+def _ocr_scale(image):
+    scale = OCR_MAX_EDGE / max(image.size)
+    dpi = image.info.get('dpi')
+    if dpi and dpi[0] and dpi[0] >= OCR_MIN_DPI:
+        scale = min(scale, OCR_TARGET_DPI / float(dpi[0]))
+    return min(scale, 1.0)
+
+def preprocess_label_image(data, timings=None):
+    """
+    Decode an uploaded label photo into a grayscale image ready for Tesseract.
+    Large JPEGs are decoded at reduced scale via Image.draft and converted
+    straight to "L"; the aspect ratio is kept. Per-step durations (seconds)
+    are written into `timings` when given.
+    """
+    from PIL import Image, ImageOps
+
+    timings = {} if timings is None else timings
+    started = time.perf_counter()
+
+    def mark(step):
+        nonlocal started
+        now = time.perf_counter()
+        timings[step] = now - started
+        started = now
+
+    image = Image.open(BytesIO(data))
+    width, height = image.size
+    scale = _ocr_scale(image)
+    target = (max(1, round(width * scale)), max(1, round(height * scale)))
+    if image.format == 'JPEG':
+        # Let libjpeg do the grayscale conversion and power-of-two downscale while decoding
+        image.draft('L', target)
+    image = image.convert('L')
+    mark('decode')
+
+    if image.size != target:
+        image = image.resize(target, Image.LANCZOS, reducing_gap=3.0)
+    mark('resize')
 
-    # OCR
-    image = Image.open(file.stream).convert('RGB')
-    image = ImageOps.grayscale(image)
-    image = image.resize((800, 800), Image.LANCZOS)
     image = ImageOps.autocontrast(image)
-    raw_text = pytesseract.image_to_string(image, lang='eng')
+    mark('autocontrast')
+
+    if OCR_CROP_TEXT:
+        # Bounding box of dark (ink) pixels, with a margin so glyph edges survive
+        bbox = ImageOps.invert(image).point(lambda p: 255 if p > 128 else 0).getbbox()
+        if bbox:
+            pad = max(8, min(image.size) // 50)
+            image = image.crop((max(0, bbox[0] - pad), max(0, bbox[1] - pad),
+                                min(image.width, bbox[2] + pad), min(image.height, bbox[3] + pad)))
+        mark('crop')
+
+    return image
+
+def ocr_image_bytes(data):
+    """
+    OCR an uploaded image. Returns (raw_text, timings) where timings maps each
+    preprocessing step and "tesseract" to seconds spent.
+    """
+    # Runs inside the OCR worker processes, so it must stay a plain top-level function
+    try:
+        import pytesseract
+        if TESSERACT_CMD:
+            pytesseract.pytesseract.tesseract_cmd = TESSERACT_CMD
+        timings = {}
+        image = preprocess_label_image(data, timings)
+        started = time.perf_counter()
+        raw_text = pytesseract.image_to_string(image, lang='eng', config=f'--dpi {OCR_TARGET_DPI}',
+                                               timeout=OCR_JOB_TIMEOUT)
+        timings['tesseract'] = time.perf_counter() - started
+        return raw_text, timings
+    except Exception as e:
+        # Some pytesseract/PIL errors don't survive pickling back to the web worker
+        raise RuntimeError(str(e) or e.__class__.__name__) from None
+
+# ---------------- OCR result cache ----------------
+# Two tiers: a per-process LRU of recent texts in front of the ocr_cache table.
+_ocr_cache_lock = threading.Lock()
+_ocr_memory_cache = OrderedDict()
+ocr_cache_stats = {"memory_hits": 0, "disk_hits": 0, "phash_hits": 0, "misses": 0}
+
+def ocr_cache_key(data):
+    return hashlib.sha256(data).hexdigest()
+
+def image_phash(data):
+    """
+    "<width>x<height>:<256-bit difference hash>" of an upload. Survives
+    re-compression of the same photo; a lookup only matches on identical
+    dimensions and all 256 bits, so similar-looking labels of different
+    products are very unlikely to share it.
+    """
+    from PIL import Image
+    image = Image.open(BytesIO(data))
+    width, height = image.size
+    image.draft('L', (128, 128))
+    pixels = image.convert('L').resize((17, 16), Image.BILINEAR).tobytes()
+    bits = 0
+    for row in range(16):
+        for col in range(16):
+            bits = (bits << 1) | (pixels[row * 17 + col] > pixels[row * 17 + col + 1])
+    return f"{width}x{height}:{bits:064x}"
+
+def _remember_ocr_text(key, text):
+    with _ocr_cache_lock:
+        _ocr_memory_cache[key] = text
+        _ocr_memory_cache.move_to_end(key)
+        while len(_ocr_memory_cache) > OCR_CACHE_MEMORY_ITEMS:
+            _ocr_memory_cache.popitem(last=False)
+
+def ocr_cache_get(key, phash=None):
+    """Return cached OCR text for an upload, or None on a miss."""
+    with _ocr_cache_lock:
+        text = _ocr_memory_cache.get(key)
+        if text is not None:
+            _ocr_memory_cache.move_to_end(key)
+            ocr_cache_stats["memory_hits"] += 1
+            return text
+
+    with db_connection() as conn:
+        row = conn.execute("SELECT hash, text FROM ocr_cache WHERE hash = ?", (key,)).fetchone()
+        stat = "disk_hits"
+        if row is None and phash is not None:
+            row = conn.execute("SELECT hash, text FROM ocr_cache WHERE phash = ? ORDER BY last_used DESC LIMIT 1",
+                               (phash,)).fetchone()
+            stat = "phash_hits"
+        if row is not None:
+            conn.execute("UPDATE ocr_cache SET last_used = ? WHERE hash = ?", (time.time(), row['hash']))
+            conn.commit()
 
+    if row is None:
+        ocr_cache_stats["misses"] += 1
+        return None
+    ocr_cache_stats[stat] += 1
+    _remember_ocr_text(key, row['text'])
+    return row['text']
+
+def ocr_cache_put(key, text, phash=None):
+    _remember_ocr_text(key, text)
+    size = len(text.encode('utf-8'))
+    with db_connection() as conn:
+        conn.execute("INSERT OR REPLACE INTO ocr_cache (hash, phash, text, size, last_used) VALUES (?, ?, ?, ?, ?)",
+                     (key, phash, text, size, time.time()))
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM ocr_cache").fetchone()[0]
+        if total > OCR_CACHE_MAX_BYTES:
+            # Evict least recently used entries until the table fits again
+            for row in conn.execute("SELECT hash, size FROM ocr_cache ORDER BY last_used").fetchall():
+                if total <= OCR_CACHE_MAX_BYTES:
+                    break
+                conn.execute("DELETE FROM ocr_cache WHERE hash = ?", (row['hash'],))
+                total -= row['size']
+        conn.commit()
+
+def build_scan_result(raw_text, user, save_history=True):
+    """
+    Everything /scan does after OCR: detection, messaging, alternatives,
+    health score, predictive risks and the history insert.
+    Returns the JSON-ready response dict. With save_history=False the caller
+    is responsible for recording the scan (see /scan_batch).
+    """
     # ------------------ Step 1: Detect allergens ------------------
-    detections = detect_allergens_from_text(raw_text)
+    with timed_stage("detect"):
+        detections, masks = detect_allergens_with_masks(raw_text)
 
     # User allergies
-    user = get_user_by_id(session['user_id'])
-    user_allergies = set(json.loads(user['allergies'])) if user else set()
+    user_allergies = user['allergy_set'] if user else frozenset()
+    user_mask = user['allergy_mask'] if user else 0
 
-    # Relevant allergens
-    relevant = [d["allergen"] for d in detections if d["allergen"] in user_allergies]
+    # Relevant allergens, bucketed by severity with one AND per bucket
+    high = mask_to_allergens(masks["high"] & user_mask)
+    medium = mask_to_allergens(masks["medium"] & user_mask)
+    low = mask_to_allergens(masks["low"] & user_mask)
+    relevant = high + medium + low
 
     # ------------------ Step 2: Severity-based message ------------------
     if detections:
-        high = [d["allergen"] for d in detections if d["severity"] == "high" and d["allergen"] in user_allergies]
-        medium = [d["allergen"] for d in detections if d["severity"] == "medium" and d["allergen"] in user_allergies]
-        low = [d["allergen"] for d in detections if d["severity"] == "low" and d["allergen"] in user_allergies]
-
         parts = []
         if high:
             parts.append(f"🚨 High Risk: {', '.join(high)}")
@@ -460,21 +2737,26 @@ def scan():
         message = "✅ No allergens detected at all."
 
     # ------------------ ✅ New Feature 1: Safe Alternatives ------------------
-    allergen_keys = list({d['allergen'] for d in detections}) if detections else []
-    safe_alts = {a: get_safe_alternatives(a) for a in allergen_keys}
+    allergen_keys = mask_to_allergens(masks["high"] | masks["medium"] | masks["low"])
+    with timed_stage("safe_alternatives"):
+        safe_alts = {a: get_safe_alternatives(a) for a in allergen_keys}
 
     # ------------------ ✅ New Feature 2: Health Score ------------------
-    health = compute_health_score(raw_text)  # returns {"score": int, "found": [(ingredient, weight), ...]}
+    with timed_stage("health_score"):
+        health = compute_health_score(raw_text)  # returns {"score": int, "found": [(ingredient, weight), ...]}
 
     # ------------------ ✅ New Feature 3: Predictive Risks ------------------
-    predictive = get_predictive_allergens_from_text(raw_text)
+    with timed_stage("predictive"):
+        predictive = get_predictive_allergens_from_text(raw_text)
 
     # ------------------ ✅ New Feature 4: Save Scan History ------------------
-    username = user['username'] if user else 'guest'
-    save_scan_history(username, "unknown", raw_text, allergen_keys)
+    if save_history:
+        username = user['username'] if user else 'guest'
+        with timed_stage("history_insert"):
+            save_scan_history(username, "unknown", raw_text, allergen_keys, detections)
 
     # ------------------ Response ------------------
-    return jsonify({
+    return {
         "raw_text": raw_text,
         "detections": detections,
         "user_allergies": list(user_allergies),
@@ -484,44 +2766,332 @@ def scan():
         "health_score": health["score"],             # new
         "health_found": health["found"],             # new
         "predictive_allergens": predictive           # new
-    }), 200
+    }
+
+
+_ocr_pool = {}
+
+def _get_ocr_executor():
+    if _ocr_pool.get('pid') != os.getpid():
+        _ocr_pool['executor'] = ProcessPoolExecutor(max_workers=OCR_WORKERS)
+        _ocr_pool['slots'] = threading.BoundedSemaphore(OCR_QUEUE_SIZE)
+        # Finishing a job (scoring, cache/DB writes) must not run on the pool's
+        # result thread, which would hold up every other job's completion
+        _ocr_pool['finisher'] = ThreadPoolExecutor(max_workers=min(4, OCR_WORKERS), thread_name_prefix='ocr-finish')
+        _ocr_pool['pid'] = os.getpid()
+    return _ocr_pool
+
+def _run_ocr_job(job_id, data):
+    # Runs in an OCR worker: the job's timeout starts now, not when it was queued
+    try:
+        with db_connection() as conn:
+            conn.execute("UPDATE ocr_jobs SET deadline = ? WHERE id = ? AND status = 'pending'",
+                         (time.time() + OCR_JOB_TIMEOUT, job_id))
+            conn.commit()
+    except Exception:
+        # The submit-time deadline already covers a full queue; carry on
+        app.logger.warning("could not start the clock for OCR job %s", job_id, exc_info=True)
+    return ocr_image_bytes(data)
+
+def _finish_ocr_job(job_id, user_id, future, cache_key=None, phash=None):
+    try:
+        user = get_user_by_id(user_id)
+        try:
+            raw_text, timings = future.result()
+            for stage, seconds in timings.items():
+                record_stage(stage, seconds)
+            if cache_key:
+                ocr_cache_put(cache_key, raw_text, phash)
+            result = build_scan_result(raw_text, user, save_history=False)
+            status, payload, error = 'done', json.dumps(result), None
+        except Exception as e:
+            status, payload, error = 'failed', None, str(e) or e.__class__.__name__
+        with db_connection() as conn:
+            # A job already reported as timed out stays failed
+            finished = conn.execute("UPDATE ocr_jobs SET status = ?, result = ?, error = ? WHERE id = ? AND status = 'pending'",
+                                    (status, payload, error, job_id)).rowcount
+            conn.commit()
+        if finished and status == 'done':
+            allergen_keys = list(dict.fromkeys(d['allergen'] for d in result['detections']))
+            save_scan_history(user['username'] if user else 'guest', "unknown", raw_text, allergen_keys,
+                              result['detections'])
+    except Exception:
+        app.logger.exception("OCR job %s could not be finished", job_id)
+
+def submit_ocr_job(data, user_id, cache_key=None, phash=None):
+    """
+    Queue an uploaded image for OCR. Returns the job id, or None when the
+    queue is full and the caller should ask the client to retry.
+    The OCR text is stored in the OCR cache under cache_key/phash when given.
+    """
+    pool = _get_ocr_executor()
+    executor, slots, finisher = pool['executor'], pool['slots'], pool['finisher']
+    if not slots.acquire(blocking=False):
+        return None
+
+    job_id = uuid.uuid4().hex
+    now = time.time()
+    # Until a worker picks the job up (see _run_ocr_job), allow for waiting
+    # behind a full queue: OCR_QUEUE_SIZE jobs, OCR_WORKERS at a time
+    queued_deadline = now + OCR_JOB_TIMEOUT * (-(-OCR_QUEUE_SIZE // OCR_WORKERS) + 1)
+    with db_connection() as conn:
+        conn.execute("DELETE FROM ocr_jobs WHERE created < ?", (now - OCR_JOB_RETENTION,))
+        conn.execute("INSERT INTO ocr_jobs (id, user_id, status, created, deadline) VALUES (?, ?, 'pending', ?, ?)",
+                     (job_id, user_id, now, queued_deadline))
+        conn.commit()
 
-@app.route('/scan_barcode', methods=['POST'])
+    def done(future):
+        slots.release()
+        finisher.submit(_finish_ocr_job, job_id, user_id, future, cache_key, phash)
+
+    try:
+        future = executor.submit(_run_ocr_job, job_id, data)
+    except BrokenProcessPool:
+        # A worker died (e.g. OOM on a huge image); start a fresh pool next time
+        _ocr_pool.clear()
+        future = _failed_future(RuntimeError('OCR worker pool restarted, please retry'))
+    future.add_done_callback(done)
+    return job_id
+
+def _failed_future(exc):
+    future = Future()
+    future.set_exception(exc)
+    return future
+
+def get_ocr_job(job_id):
+    with db_connection() as conn:
+        row = conn.execute("SELECT * FROM ocr_jobs WHERE id = ?", (job_id,)).fetchone()
+        if row and row['status'] == 'pending' and time.time() > row['deadline'] + 5:
+            # Worker never reported back (crashed or hung past its timeout)
+            conn.execute("UPDATE ocr_jobs SET status = 'failed', error = 'OCR timed out' WHERE id = ? AND status = 'pending'",
+                         (job_id,))
+            conn.commit()
+            row = conn.execute("SELECT * FROM ocr_jobs WHERE id = ?", (job_id,)).fetchone()
+    return dict(row) if row else None
+
+
+@app.route('/scan', methods=['GET','POST'])
+@login_required
+def scan():
+    if request.method == 'GET':
+        return render_template('scan.html', display=DISPLAY_NAME)
+
+    # handle uploaded image
+    file = request.files.get('image')
+    if not file or file.filename == '':
+        return jsonify({'error': 'No image file provided.'}), 400
+    data = file.read()
+
+    # Same photo seen before: skip preprocessing and Tesseract entirely
+    with timed_stage("ocr_cache_lookup"):
+        cache_key = ocr_cache_key(data)
+        phash = image_phash(data) if OCR_CACHE_PHASH else None
+        raw_text = ocr_cache_get(cache_key, phash)
+    if raw_text is not None:
+        return jsonify(build_scan_result(raw_text, get_user_by_id(session['user_id']))), 200
+
+    if OCR_MODE == 'sync':
+        raw_text, timings = ocr_image_bytes(data)
+        for stage, seconds in timings.items():
+            record_stage(stage, seconds)
+        ocr_cache_put(cache_key, raw_text, phash)
+        return jsonify(build_scan_result(raw_text, get_user_by_id(session['user_id']))), 200
+
+    job_id = submit_ocr_job(data, session['user_id'], cache_key, phash)
+    if job_id is None:
+        resp = jsonify({'error': 'Scanner is busy, please try again in a moment.'})
+        resp.headers['Retry-After'] = '2'
+        return resp, 503
+    return jsonify({
+        "job_id": job_id,
+        "status": "pending",
+        "status_url": url_for('scan_job', job_id=job_id)
+    }), 202
+
+@app.route('/scan/jobs/<job_id>')
+@login_required
+def scan_job(job_id):
+    # Answers at once; clients poll with backoff rather than holding a worker
+    job = get_ocr_job(job_id)
+    if not job or job['user_id'] != session['user_id']:
+        return jsonify({'error': 'Unknown scan job.'}), 404
+    if job['status'] == 'done':
+        return jsonify(json.loads(job['result'])), 200
+    if job['status'] == 'failed':
+        return jsonify({'error': f"Scan failed: {job['error']}", 'job_id': job_id}), 500
+    return jsonify({"job_id": job_id, "status": "pending",
+                    "status_url": url_for('scan_job', job_id=job_id)}), 202
+
+@app.route('/scan_barcode', methods=['GET', 'POST'])
 @login_required
 def scan_barcode():
-    data = request.get_json()
-    barcode = data.get("barcode")
-
-    # For demo: sample mapping (later connect to OpenFoodFacts API)
-    demo_products = {
-        "8901234567890": {"name": "Chocolate Bar", "ingredients": "Milk, Sugar, Cocoa, Peanut oil"},
-        "8909876543210": {"name": "Oat Milk", "ingredients": "Water, Oats, Salt"},
-        "8901111111111": {"name": "Plain Water", "ingredients": ""}  # no ingredients listed
-    }
+    if request.method == 'GET':
+        barcode = request.args.get("barcode", "")
+    else:
+        data = request.get_json()
+        barcode = data.get("barcode")
 
-    product = demo_products.get(barcode)
+    product = get_product_by_barcode(barcode)
     if not product:
         return jsonify({"error": "Product not found in database"}), 404
 
+    if request.method == 'GET':
+        # Cacheable form: revalidated against the catalog row's `updated` time
+        return conditional_response(("product", barcode, product["updated"]),
+                                    _parse_utc(product["updated"]), lambda: _barcode_payload(product))
+    return _barcode_payload(product)
+
+def _barcode_payload(product):
     raw_text = product.get("ingredients", "")
 
     # If no ingredients available → ask user to scan manually
     if not raw_text.strip():
         return jsonify({"error": f"No ingredients available for {product['name']}."}), 200
 
-    # Otherwise, process normally
-    detections = detect_allergens_from_text(raw_text)
-    health = compute_health_score(raw_text)
-    predictive = get_predictive_allergens_from_text(raw_text)
-
+    # Otherwise, return the analysis stored with the product
     return jsonify({
         "product_name": product["name"],
         "ingredients": raw_text,
-        "detections": detections,
-        "health_score": health["score"],
-        "predictive_allergens": predictive
+        "detections": product["detections"],
+        "health_score": product["health_score"],
+        "predictive_allergens": product["predictive_allergens"]
     })
 
+# ---------- Batch scanning (many images / texts / barcodes, streamed as NDJSON) ----------
+SCAN_BATCH_MAX = int(os.environ.get('SCAN_BATCH_MAX', '100'))
+SCAN_BATCH_SAVE_EVERY = int(os.environ.get('SCAN_BATCH_SAVE_EVERY', '10'))  # scans per history transaction
+
+def _ocr_batch(images):
+    """
+    Yield (index, raw_text, error) for uploaded images as their OCR finishes.
+    Cached images come back first; the rest run on the OCR pool, at most
+    OCR_WORKERS at a time so one batch can't swamp the worker, and each
+    holding one of the OCR_QUEUE_SIZE slots single scans queue for.
+    """
+    todo = []
+    for index, data in images:
+        cache_key = ocr_cache_key(data)
+        raw_text = ocr_cache_get(cache_key)
+        if raw_text is not None:
+            yield index, raw_text, None
+        else:
+            todo.append((index, data, cache_key))
+
+    if OCR_MODE == 'sync':
+        for index, data, cache_key in todo:
+            try:
+                raw_text, timings = ocr_image_bytes(data)
+            except Exception as e:
+                yield index, None, str(e)
+                continue
+            for stage, seconds in timings.items():
+                record_stage(stage, seconds)
+            ocr_cache_put(cache_key, raw_text)
+            yield index, raw_text, None
+        return
+
+    pool = _get_ocr_executor()
+    executor, slots = pool['executor'], pool['slots']
+    todo.reverse()
+    running = {}
+    while todo or running:
+        while todo and len(running) < OCR_WORKERS:
+            # With work in flight just try; otherwise wait for another request's job to free a slot
+            if not (slots.acquire(blocking=False) if running else slots.acquire(timeout=OCR_JOB_TIMEOUT)):
+                if running:
+                    break
+                yield todo.pop()[0], None, 'Scanner is busy, please try again in a moment.'
+                continue
+            index, data, cache_key = todo.pop()
+            try:
+                future = executor.submit(ocr_image_bytes, data)
+            except BrokenProcessPool:
+                _ocr_pool.clear()
+                future = _failed_future(RuntimeError('OCR worker pool restarted, please retry'))
+            future.add_done_callback(lambda _: slots.release())
+            running[future] = (index, cache_key)
+        finished, _ = wait(running, return_when=FIRST_COMPLETED)
+        for future in finished:
+            index, cache_key = running.pop(future)
+            try:
+                raw_text, timings = future.result()
+            except Exception as e:
+                yield index, None, str(e)
+                continue
+            for stage, seconds in timings.items():
+                record_stage(stage, seconds)
+            ocr_cache_put(cache_key, raw_text)
+            yield index, raw_text, None
+
+@app.route('/scan_batch', methods=['POST'])
+@login_required
+def scan_batch():
+    """
+    Accepts multipart `images` files, or JSON {"texts": [...]} / {"barcodes": [...]}.
+    Streams one JSON object per line as each item finishes, tagged with its
+    input index; all scan_history rows are written in one transaction at the end.
+    """
+    files = [f for f in request.files.getlist('images') if f and f.filename]
+    payload = {} if files else (request.get_json(silent=True) or {})
+    if not isinstance(payload, dict):
+        return jsonify({'error': 'Expected a JSON object.'}), 400
+    texts = payload.get('texts') or []
+    barcodes = payload.get('barcodes') or []
+    for name, items in (('texts', texts), ('barcodes', barcodes)):
+        if not isinstance(items, list) or not all(isinstance(item, str) for item in items):
+            return jsonify({'error': f'"{name}" must be a list of strings.'}), 400
+    count = len(files) + len(texts) + len(barcodes)
+    if not count:
+        return jsonify({'error': 'Provide images, texts or barcodes.'}), 400
+    if count > SCAN_BATCH_MAX:
+        return jsonify({'error': f'At most {SCAN_BATCH_MAX} items per batch.'}), 413
+
+    user = get_user_by_id(session['user_id'])
+    username = user['username'] if user else 'guest'
+    images = [(i, f.read()) for i, f in enumerate(files)]
+
+    def generate():
+        # History is written a chunk at a time while streaming, so scans the
+        # client was already sent survive a dropped connection or a killed worker
+        history = []
+
+        def save_history():
+            if history:
+                save_scan_history_many(history)
+                history.clear()
+
+        def finish(index, kind, raw_text, product_name="unknown", **extra):
+            result = build_scan_result(raw_text, user, save_history=False)
+            result.update(index=index, type=kind, product_name=product_name, **extra)
+            allergen_keys = list({d['allergen'] for d in result['detections']})
+            history.append((username, product_name, raw_text, allergen_keys, result['detections']))
+            if len(history) >= SCAN_BATCH_SAVE_EVERY:
+                save_history()
+            return json.dumps(result) + "\n"
+
+        try:
+            for index, text in enumerate(texts):
+                yield finish(index, "text", text)
+
+            for index, barcode in enumerate(barcodes):
+                product = get_product_by_barcode(barcode)
+                if not product or not (product.get("ingredients") or "").strip():
+                    error = "Product not found in database" if not product else f"No ingredients available for {product['name']}."
+                    yield json.dumps({"index": index, "type": "barcode", "barcode": barcode, "error": error}) + "\n"
+                    continue
+                yield finish(index, "barcode", product["ingredients"], product["name"], barcode=barcode)
+
+            for index, raw_text, error in _ocr_batch(images):
+                if error is not None:
+                    yield json.dumps({"index": index, "type": "image", "error": f"Scan failed: {error}"}) + "\n"
+                    continue
+                yield finish(index, "image", raw_text)
+        finally:
+            # also runs when the client disconnects and the response is closed
+            save_history()
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
 # ---------- Profile page (view + update allergies, list user feedback & history) ----------
 @app.route('/myprofile', methods=['GET', 'POST'])
 @login_required
@@ -536,15 +3106,31 @@ def user_profile():
         new_allergies_raw = request.form.get('allergies', '')
         new_allergies = [a.strip() for a in new_allergies_raw.split(',') if a.strip()]
         update_user_allergies(user['id'], new_allergies)
-        # Refresh user object
-        user = get_user_by_id(user['id'])
         return redirect(url_for('profile'))
 
     # GET: gather user-related data
-    user_allergies = json.loads(user['allergies']) if user.get('allergies') else []
-    feedback_list = get_feedback_by_user(user['username'])
-    history = get_scan_history_by_user(user['username'])
-    return render_template('profile.html', user=user, user_allergies=user_allergies, feedback=feedback_list, history=history)
+    user_allergies = list(user['allergy_list'])
+    page_size = 50
+    feedback_list = get_feedback_by_user(user['username'], page_size, decode_cursor(request.args.get('feedback_before')))
+    history = get_scan_history_by_user(user['username'], page_size, decode_cursor(request.args.get('history_before')))
+    return render_template('profile.html', user=user, user_allergies=user_allergies, feedback=feedback_list, history=history,
+                           feedback_next=next_cursor(feedback_list, page_size),
+                           history_next=next_cursor(history, page_size))
+
+
+@app.route('/export')
+@login_required
+def export_my_data():
+    kind = request.args.get('kind', 'all')
+    fmt = request.args.get('format', 'csv')
+    if kind not in EXPORT_KINDS or fmt not in EXPORT_FORMATS:
+        return jsonify({"error": f"kind must be one of {', '.join(EXPORT_KINDS)}; format one of {', '.join(EXPORT_FORMATS)}"}), 400
+    compress = request.args.get('gzip') == '1'
+    user = get_user_by_id(session['user_id'])
+    filename = f"{user['username']}-{kind}.{fmt}" + (".gz" if compress else "")
+    mimetype = "application/gzip" if compress else ("text/csv" if fmt == "csv" else "application/x-ndjson")
+    return Response(stream_with_context(export_user_data(user['username'], kind, fmt, compress)), mimetype=mimetype,
+                    headers={"Content-Disposition": f'attachment; filename="{filename}"'})
 
 
 # ---------- Community page (aggregates + recent feedback) ----------
@@ -552,25 +3138,24 @@ def user_profile():
 @login_required
 def community():
     user = get_user_by_id(session['user_id'])                 # add this
-    user_allergies = json.loads(user['allergies']) if user else []
-
-    conn = get_db_connection()
-    agg_products = conn.execute(
-        "SELECT product_name, COUNT(*) as cnt FROM feedback GROUP BY product_name ORDER BY cnt DESC LIMIT 100"
-    ).fetchall()
-    recent = conn.execute(
-        "SELECT username, product_name, reaction, notes, timestamp FROM feedback ORDER BY timestamp DESC LIMIT 100"
-    ).fetchall()
-    conn.close()
-
-    return render_template(
-        "community.html",
-        user=user,
-        user_allergies=user_allergies,
-        display=DISPLAY_NAME,
-        agg_products=agg_products,
-        recent=recent
-    )
+    user_allergies = list(user['allergy_list']) if user else []
+    before = decode_cursor(request.args.get('before'))
+    version, latest = get_feedback_version()
+
+    def render():
+        agg_products = get_top_reported_products(100, version)
+        recent = get_all_feedback(100, before)
+        return render_template(
+            "community.html",
+            user=user,
+            user_allergies=user_allergies,
+            display=DISPLAY_NAME,
+            agg_products=agg_products,
+            recent=recent,
+            recent_next=next_cursor(recent, 100)
+        )
+
+    return conditional_response(("community", session['user_id'], before, version), _parse_utc(latest), render)
 
 
 
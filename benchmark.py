@@ -0,0 +1,495 @@
+# benchmark.py
+"""
+Reproducible benchmarks for the detection / scoring / OCR pipeline.
+
+    python benchmark.py                      # run everything, print JSON
+    python benchmark.py -o before.json       # save results
+    python benchmark.py -o after.json --compare before.json
+    python benchmark.py --only detect,health --quick
+    python benchmark.py --only transfer      # response bytes / latency per encoding
+    python benchmark.py --load http://127.0.0.1:8000 --concurrency 16 --duration 30
+
+Synthetic inputs are generated from a fixed seed so two runs measure the same
+work. The app is imported against a throwaway copy of the database with
+OCR_MODE=sync, so nothing touches allergy_app.db. OCR benchmarks are skipped
+when the tesseract binary is not installed.
+"""
+import argparse
+import http.cookiejar
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import textwrap
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+FILLER_WORDS = [
+    "water", "salt", "oats", "rice", "cocoa", "corn starch", "vegetable oil", "citric acid", "yeast",
+    "natural flavour", "vinegar", "pepper", "garlic", "onion powder", "tomato paste", "maltodextrin",
+    "palm oil", "glucose syrup", "emulsifier", "stabiliser", "colour", "antioxidant", "raising agent",
+]
+LABEL_PHRASES = ["may contain traces of nuts", "produced in a facility that handles sesame", "gluten-free", "milk free"]
+# Real ingredient words a letter or two away from an allergen keyword: clean
+# labels built from these must not produce fuzzy hits.
+NEAR_MISS_WORDS = [
+    "calcium sulfate", "ferrous sulfate", "zinc sulphate", "lactase", "lactate", "custard", "spent grain",
+    "cheat", "spell", "smelt", "meat", "heat", "silk", "mild", "mill", "peas", "pecorino", "lupus",
+    "sugars", "sweeteners", "sulfur", "seeds", "muster", "wheal", "malt", "soda",
+]
+
+
+# ---------------- synthetic inputs ----------------
+def make_texts(rng, keywords, words, density, count):
+    """Ingredient lists of `words` items where roughly `density` of them are allergen keywords."""
+    texts = []
+    for _ in range(count):
+        items = []
+        for _ in range(words):
+            if rng.random() < density:
+                items.append(rng.choice(keywords))
+            else:
+                items.append(rng.choice(FILLER_WORDS))
+        if rng.random() < 0.3:
+            items.append(rng.choice(LABEL_PHRASES))
+        texts.append("Ingredients: " + ", ".join(items) + ".")
+    return texts
+
+
+OCR_NOISE = [("a", "4"), ("o", "0"), ("l", "1"), ("s", "5"), ("m", "rn"), ("w", "vv")]
+OCR_LOOKALIKES = {"c": "e", "e": "c", "o": "c", "i": "l", "l": "i", "t": "l", "f": "t", "h": "b", "n": "h", "u": "n"}
+
+
+def ocr_noise(rng, word):
+    """Damage a keyword the way OCR does: confusable glyph, split word or one lookalike letter."""
+    kind = rng.randrange(3)
+    if kind == 0:
+        options = [(a, b) for a, b in OCR_NOISE if a in word]
+        if options:
+            a, b = rng.choice(options)
+            return word.replace(a, b, 1)
+    if kind == 1 and len(word) > 4:
+        cut = rng.randrange(2, len(word) - 1)
+        return word[:cut] + " " + word[cut:]
+    positions = [i for i, ch in enumerate(word) if ch in OCR_LOOKALIKES] or [rng.randrange(len(word))]
+    pos = rng.choice(positions)
+    return word[:pos] + OCR_LOOKALIKES.get(word[pos], word[pos]) + word[pos + 1:]
+
+
+def make_noisy_texts(rng, allergens, words, count):
+    """(text, allergen key) pairs where one allergen keyword is OCR-damaged and nothing else matches."""
+    pairs = []
+    candidates = [(key, kw) for key, kws in allergens.items() for kw in kws if " " not in kw and len(kw) >= 5]
+    for _ in range(count):
+        key, kw = rng.choice(candidates)
+        items = [rng.choice(FILLER_WORDS) for _ in range(words)]
+        items.insert(rng.randrange(len(items) + 1), ocr_noise(rng, kw))
+        pairs.append(("Ingredients: " + ", ".join(items) + ".", key))
+    return pairs
+
+
+def run_fuzzy_suite(app, rng, args):
+    """Latency of detection with fuzzy matching on/off, plus recall on damaged keywords and false positives on clean text."""
+    results = {}
+    count = 100 if args.quick else 500
+    noisy = make_noisy_texts(rng, app.PREDEFINED_ALLERGENS, 40, count)
+    clean = ["Ingredients: " + ", ".join(rng.choice(FILLER_WORDS + NEAR_MISS_WORDS) for _ in range(40)) + "."
+             for _ in range(count)]
+    original = app.FUZZY_MATCHING
+    try:
+        for enabled in (False, True):
+            app.FUZZY_MATCHING = enabled
+            app._fuzzy_word_hits.cache_clear()
+            label = "fuzzy" if enabled else "exact"
+            stats = bench(app.detect_allergens_from_text, [t for t, _ in noisy], warmup=0)
+            found = sum(any(d["allergen"] == key and d["severity"] == "high" for d in app.detect_allergens_from_text(t))
+                        for t, key in noisy)
+            false_pos = sum(any(d["severity"] == "high" for d in app.detect_allergens_from_text(t)) for t in clean)
+            stats.update({"recall": round(found / len(noisy), 3), "false_positive_rate": round(false_pos / len(clean), 3)})
+            results[f"detect_allergens_from_text[ocr-noise,{label}]"] = stats
+    finally:
+        app.FUZZY_MATCHING = original
+    return results
+
+
+def make_label_image(rng, size, text, fmt="JPEG", dpi=None, font_px=None):
+    from PIL import Image, ImageDraw, ImageFont
+    image = Image.new("RGB", size, (250, 248, 240))
+    draw = ImageDraw.Draw(image)
+    # a little noise so every image hashes differently (defeats the OCR cache)
+    for _ in range(50):
+        x, y = rng.randrange(size[0]), rng.randrange(size[1])
+        draw.point((x, y), fill=(rng.randrange(256),) * 3)
+    font = ImageFont.load_default(size=font_px) if font_px else None
+    line_height = max(12, size[1] // 40, int((font_px or 0) * 1.4))
+    if font_px:
+        # whole words per line, so keywords are never split across lines
+        lines = textwrap.wrap(text, max(10, int(size[0] * 0.9 / (font_px * 0.6))))
+    else:
+        lines = [text[start:start + 60] for start in range(0, len(text), 60)]
+    y = line_height
+    for line in lines:
+        draw.text((size[0] // 20, y), line, fill=(20, 20, 20), font=font)
+        y += line_height
+        if y > size[1] - line_height:
+            break
+    buf = io.BytesIO()
+    image.save(buf, fmt, quality=90, **({"dpi": dpi} if dpi else {}))
+    return buf.getvalue()
+
+
+def legacy_ocr(data):
+    """The original /scan pipeline (RGB -> L, stretched to 800x800), as the accuracy baseline."""
+    import pytesseract
+    from PIL import Image, ImageOps
+    image = ImageOps.grayscale(Image.open(io.BytesIO(data)).convert("RGB"))
+    image = ImageOps.autocontrast(image.resize((800, 800), Image.LANCZOS))
+    return pytesseract.image_to_string(image, lang="eng")
+
+
+def run_ocr_accuracy(app, rng, args):
+    """
+    Allergen detection accuracy of the OCR pipeline against the original one on
+    a sample label set: phone-style photos tagged 72/96 dpi plus real scans.
+    """
+    if not tesseract_available():
+        return {"ocr_accuracy": {"skipped": "tesseract not installed"}}
+    keywords = [kw for kws in app.PREDEFINED_ALLERGENS.values() for kw in kws if len(kw) > 3]
+    label_set = [((640, 480), (96, 96)), ((1000, 750), (72, 72)), ((3000, 2250), (72, 72)), ((2480, 3508), (300, 300))]
+    per_size = 3 if args.quick else 10
+
+    def allergens(text):
+        return {d["allergen"] for d in app.detect_allergens_from_text(text) if d["severity"] == "high"}
+
+    results = {}
+    for size, dpi in label_set:
+        texts = make_texts(rng, keywords, 12, 0.25, per_size)
+        images = [make_label_image(rng, size, t, dpi=dpi, font_px=max(12, size[0] // 40)) for t in texts]
+        expected = [allergens(t) for t in texts]
+        for name, ocr in (("current", lambda data: app.ocr_image_bytes(data)[0]), ("legacy", legacy_ocr)):
+            found = total = exact = 0
+            samples = []
+            for data, want in zip(images, expected):
+                started = time.perf_counter()
+                got = allergens(ocr(data))
+                samples.append(time.perf_counter() - started)
+                found += len(want & got)
+                total += len(want)
+                exact += got == want
+            results[f"ocr_accuracy[{size[0]}x{size[1]}@{dpi[0]}dpi,{name}]"] = summarize(samples, {
+                "allergen_recall": round(found / total, 3) if total else None,
+                "exact_label_rate": round(exact / len(images), 3),
+            })
+    return results
+
+
+# ---------------- measurement ----------------
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    k = (len(sorted_values) - 1) * pct / 100.0
+    lo, hi = int(k), min(int(k) + 1, len(sorted_values) - 1)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (k - lo)
+
+
+def summarize(samples, extra=None):
+    samples = sorted(samples)
+    total = sum(samples)
+    result = {
+        "n": len(samples),
+        "throughput_per_s": round(len(samples) / total, 2) if total else None,
+        "mean_ms": round(statistics.fmean(samples) * 1000, 4) if samples else None,
+        "p50_ms": round(percentile(samples, 50) * 1000, 4),
+        "p99_ms": round(percentile(samples, 99) * 1000, 4),
+    }
+    if extra:
+        result.update(extra)
+    return result
+
+
+def bench(fn, inputs, repeat=1, warmup=3):
+    for item in inputs[:warmup]:
+        fn(item)
+    samples = []
+    for _ in range(repeat):
+        for item in inputs:
+            started = time.perf_counter()
+            fn(item)
+            samples.append(time.perf_counter() - started)
+    return summarize(samples)
+
+
+# ---------------- suites ----------------
+def load_app(workdir):
+    """Import app.py against a scratch copy of the database."""
+    db_copy = os.path.join(workdir, "bench.db")
+    shutil.copyfile(os.path.join(APP_DIR, "allergy_app.db"), db_copy)
+    os.environ["ALLERGY_DB_PATH"] = db_copy
+    os.environ.setdefault("OCR_MODE", "sync")
+    os.environ.setdefault("WRITE_BEHIND", "0")
+    sys.path.insert(0, APP_DIR)
+    import app
+    return app
+
+
+def tesseract_available():
+    return shutil.which("tesseract") is not None
+
+
+def run_function_suites(app, rng, args, only):
+    results = {}
+    keywords = [kw for kws in app.PREDEFINED_ALLERGENS.values() for kw in kws]
+    count = 50 if args.quick else 300
+    for words in (20, 200, 2000):
+        for density in (0.0, 0.05, 0.3):
+            texts = make_texts(rng, keywords, words, density, count)
+            label = f"words={words},density={density}"
+            if "detect" in only:
+                results[f"detect_allergens_from_text[{label}]"] = bench(app.detect_allergens_from_text, texts)
+            if "health" in only:
+                results[f"compute_health_score[{label}]"] = bench(app.compute_health_score, texts)
+                batches = [texts[i:i + 50] for i in range(0, len(texts), 50)]
+                results[f"compute_health_scores[batch=50,{label}]"] = bench(app.compute_health_scores, batches, warmup=1)
+            if "predictive" in only:
+                results[f"get_predictive_allergens_from_text[{label}]"] = bench(app.get_predictive_allergens_from_text, texts)
+
+    if "fuzzy" in only:
+        results.update(run_fuzzy_suite(app, rng, args))
+
+    sizes = [(800, 600), (2000, 1500)] if args.quick else [(640, 480), (1600, 1200), (4000, 3000)]
+    image_count = 5 if args.quick else 20
+    if "preprocess" in only or "ocr" in only:
+        for size in sizes:
+            images = [make_label_image(rng, size, text) for text in make_texts(rng, keywords, 40, 0.1, image_count)]
+            label = f"{size[0]}x{size[1]}"
+            if "preprocess" in only:
+                results[f"preprocess_label_image[{label}]"] = bench(app.preprocess_label_image, images)
+            if "ocr" in only:
+                if tesseract_available():
+                    results[f"ocr_image_bytes[{label}]"] = bench(app.ocr_image_bytes, images, warmup=1)
+                else:
+                    results[f"ocr_image_bytes[{label}]"] = {"skipped": "tesseract not installed"}
+    if "ocr" in only:
+        results.update(run_ocr_accuracy(app, rng, args))
+    return results
+
+
+def run_route_suites(app, rng, args, only):
+    results = {}
+    client = app.app.test_client()
+    username = f"bench_{rng.randrange(10**9)}"
+    client.post("/signup", data={"username": username, "password": "bench", "allergies": ["milk", "peanut"]})
+    client.post("/login", data={"username": username, "password": "bench"})
+    keywords = [kw for kws in app.PREDEFINED_ALLERGENS.values() for kw in kws]
+    count = 30 if args.quick else 200
+
+    if "scan_barcode" in only:
+        barcodes = ["8901234567890", "8909876543210", "8901111111111", "0000000000000"] * (count // 4)
+        results["route:/scan_barcode"] = bench(lambda bc: client.post("/scan_barcode", json={"barcode": bc}), barcodes)
+
+    if "scan" in only:
+        if tesseract_available():
+            images = [make_label_image(rng, (1600, 1200), t) for t in make_texts(rng, keywords, 40, 0.1, max(5, count // 10))]
+
+            def post_image(data):
+                return client.post("/scan", data={"image": (io.BytesIO(data), "label.jpg")},
+                                   content_type="multipart/form-data")
+
+            results["route:/scan[cold]"] = bench(post_image, images, warmup=0)
+            results["route:/scan[cached]"] = bench(post_image, images, warmup=0)
+        else:
+            results["route:/scan"] = {"skipped": "tesseract not installed"}
+
+    if "transfer" in only:
+        results.update(run_transfer_suite(app, client, rng, keywords, count))
+
+    if "scan_batch" in only:
+        batches = [make_texts(rng, keywords, 60, 0.1, 20) for _ in range(max(3, count // 20))]
+        results["route:/scan_batch[20 texts]"] = bench(
+            lambda texts: client.post("/scan_batch", json={"texts": texts}).get_data(), batches)
+    return results
+
+
+def run_transfer_suite(app, client, rng, keywords, count):
+    """
+    Payload size and latency per Accept-Encoding for the heavy responses, plus
+    the cost of a conditional GET that comes back 304.
+    """
+    results = {}
+    # /scan without tesseract: prime the OCR cache so the upload is a cache hit
+    label = make_texts(rng, keywords, 400, 0.1, 1)[0]
+    upload = b"transfer-benchmark-label"
+    app.ocr_cache_put(app.ocr_cache_key(upload), label, None)
+    client.post("/feedback", json={"product_name": "Bench Bar", "reaction": "Hives", "notes": "x" * 200})
+    with app.app.test_request_context():
+        script = app.asset_url("scan.js")
+
+    targets = {
+        "/scan": lambda headers: client.post("/scan", data={"image": (io.BytesIO(upload), "label.jpg")},
+                                             content_type="multipart/form-data", headers=headers),
+        "/scan_barcode": lambda headers: client.get("/scan_barcode?barcode=8901234567890", headers=headers),
+        "/community": lambda headers: client.get("/community", headers=headers),
+        "/myprofile": lambda headers: client.get("/myprofile", headers=headers),
+        "/static/scan.js": lambda headers: client.get(script, headers=headers),
+    }
+    encodings = ["identity", "gzip"] + (["br"] if app._brotli() else [])
+    for path, fetch in targets.items():
+        identity_bytes = None
+        for encoding in encodings:
+            headers = {"Accept-Encoding": encoding}
+            response = fetch(headers)
+            size = len(response.get_data())
+            response.close()
+            identity_bytes = identity_bytes or size
+            results[f"transfer:{path}[{encoding}]"] = dict(
+                bench(lambda _: fetch(headers).close(), [None] * count),
+                bytes=size, ratio=round(size / identity_bytes, 3) if identity_bytes else None,
+                content_encoding=response.headers.get("Content-Encoding", "identity"))
+        etag = response.headers.get("ETag")
+        if etag and path != "/scan":
+            headers = {"Accept-Encoding": encodings[-1], "If-None-Match": etag}
+            response = fetch(headers)
+            results[f"transfer:{path}[304]"] = dict(
+                bench(lambda _: fetch(headers).close(), [None] * count),
+                bytes=len(response.get_data()), status=response.status_code)
+            response.close()
+    return results
+
+
+# ---------------- load test ----------------
+def run_load_test(args):
+    """Drive concurrent scan_barcode / page requests against a running server (e.g. gunicorn)."""
+    base = args.load.rstrip("/")
+    username = f"load_{random.randrange(10**9)}"
+    jar = http.cookiejar.CookieJar()
+    opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(jar))
+    form = urllib.parse.urlencode({"username": username, "password": "bench", "allergies": "milk"}).encode()
+    opener.open(base + "/signup", form)
+    opener.open(base + "/login", urllib.parse.urlencode({"username": username, "password": "bench"}).encode())
+
+    barcode_body = json.dumps({"barcode": "8901234567890"}).encode()
+    requests_mix = [
+        ("POST", "/scan_barcode", barcode_body),
+        ("GET", "/dashboard", None),
+        ("GET", "/community", None),
+    ]
+    samples, errors = {}, {}
+    lock = threading.Lock()
+    stop_at = time.monotonic() + args.duration
+
+    def worker(seed):
+        rng = random.Random(seed)
+        while time.monotonic() < stop_at:
+            method, path, body = rng.choice(requests_mix)
+            req = urllib.request.Request(base + path, data=body, method=method,
+                                         headers={"Content-Type": "application/json"} if body else {})
+            started = time.perf_counter()
+            try:
+                opener.open(req, timeout=30).read()
+                ok = True
+            except (urllib.error.URLError, OSError):
+                ok = False
+            elapsed = time.perf_counter() - started
+            with lock:
+                if ok:
+                    samples.setdefault(path, []).append(elapsed)
+                else:
+                    errors[path] = errors.get(path, 0) + 1
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(args.concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    results = {}
+    for path, values in samples.items():
+        results[f"load:{path}"] = summarize(values, {"errors": errors.get(path, 0),
+                                                     "requests_per_s": round(len(values) / args.duration, 2)})
+    return results
+
+
+# ---------------- reporting ----------------
+def metadata(args):
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=APP_DIR,
+                                         stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "seed": args.seed,
+        "quick": args.quick,
+    }
+
+
+def compare(current, baseline):
+    """Print p50/p99 change per benchmark against a previous JSON result."""
+    print(f"{'benchmark':60} {'p50 ms':>10} {'Δp50':>8} {'p99 ms':>10} {'Δp99':>8}", file=sys.stderr)
+    for name, now in sorted(current["results"].items()):
+        before = baseline.get("results", {}).get(name)
+        if "p50_ms" not in now:
+            continue
+        if not before or not before.get("p50_ms"):
+            print(f"{name:60} {now['p50_ms']:>10.3f} {'new':>8}", file=sys.stderr)
+            continue
+        d50 = (now["p50_ms"] - before["p50_ms"]) / before["p50_ms"] * 100
+        d99 = (now["p99_ms"] - before["p99_ms"]) / before["p99_ms"] * 100 if before.get("p99_ms") else 0.0
+        print(f"{name:60} {now['p50_ms']:>10.3f} {d50:>+7.1f}% {now['p99_ms']:>10.3f} {d99:>+7.1f}%", file=sys.stderr)
+
+
+ALL_SUITES = ["detect", "fuzzy", "health", "predictive", "preprocess", "ocr", "scan", "scan_barcode", "scan_batch",
+              "transfer"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-o", "--output", help="write JSON results to this file (default: stdout)")
+    parser.add_argument("--compare", help="previous JSON result to compare against")
+    parser.add_argument("--only", help="comma-separated subset of: " + ",".join(ALL_SUITES))
+    parser.add_argument("--quick", action="store_true", help="fewer iterations, smaller inputs")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--load", metavar="URL", help="load-test a running server instead of in-process benchmarks")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=20.0, help="load test length in seconds")
+    args = parser.parse_args()
+
+    report = {"meta": metadata(args), "results": {}}
+    if args.load:
+        report["meta"]["load"] = {"url": args.load, "concurrency": args.concurrency, "duration": args.duration}
+        report["results"] = run_load_test(args)
+    else:
+        only = set(args.only.split(",")) if args.only else set(ALL_SUITES)
+        rng = random.Random(args.seed)
+        with tempfile.TemporaryDirectory() as workdir:
+            app = load_app(workdir)
+            report["results"].update(run_function_suites(app, rng, args, only))
+            report["results"].update(run_route_suites(app, rng, args, only))
+            app.flush_write_behind()
+
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as fh:
+            fh.write(text + "\n")
+    else:
+        print(text)
+    if args.compare:
+        with open(args.compare) as fh:
+            compare(report, json.load(fh))
+
+
+if __name__ == "__main__":
+    main()
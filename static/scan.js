@@ -96,8 +96,16 @@ document.addEventListener('DOMContentLoaded', function () {
         scanCapturedBtn.style.display = 'none'; // Hide button after clicking
 
         try {
-            const res = await fetch('/scan', { method: 'POST', body: form });
-            const data = await res.json();
+            let res = await fetch('/scan', { method: 'POST', body: form });
+            let data = await res.json();
+            // Async mode: the server queues the image and hands back a job to poll
+            let delay = 300;
+            while (res.status === 202 && data.status_url) {
+                await new Promise(resolve => setTimeout(resolve, delay));
+                delay = Math.min(delay * 1.5, 3000);
+                res = await fetch(data.status_url);
+                data = await res.json();
+            }
             if (!res.ok) {
                 resultDiv.innerHTML = `<p style="color: red;">${data.error || 'Scan failed'}</p>`;
                 return;
@@ -140,11 +148,8 @@ document.addEventListener('DOMContentLoaded', function () {
             document.getElementById("barcodeResult").textContent = code; // Update result display
             document.getElementById("barcodeResultBox").style.display = 'block';
 
-            fetch("/scan_barcode", {
-                method: "POST",
-                headers: { "Content-Type": "application/json" },
-                body: JSON.stringify({ barcode: code })
-            })
+            // GET so the browser can revalidate a product it has already looked up (304)
+            fetch("/scan_barcode?barcode=" + encodeURIComponent(code))
             .then(res => res.json())
             .then(data => {
                 if (data.error) {
@@ -178,7 +183,7 @@ document.addEventListener('DOMContentLoaded', function () {
         if (data.message) html += `<strong>${data.message}</strong><br/><br/>`;
 
         if (data.detections?.length)
-            html += `<div><strong>Detected Allergens:</strong> ${data.detections.map(d => `${d.allergen} (${d.severity})`).join(', ')}</div>`;
+            html += `<div><strong>Detected Allergens:</strong> ${data.detections.map(d => `${d.allergen} (${d.severity}${d.confidence < 1 ? `, ${Math.round(d.confidence * 100)}% match` : ''})`).join(', ')}</div>`;
 
         if (data.user_allergies?.length)
             html += `<div><strong>Your Allergies:</strong> ${data.user_allergies.join(', ')}</div>`;
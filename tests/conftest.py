@@ -0,0 +1,49 @@
+# tests/conftest.py
+# app.py opens (and migrates) its database at import time, so point it at a
+# throwaway SQLite file before any test imports it.
+import itertools
+import os
+import shutil
+import sys
+import tempfile
+
+import pytest
+
+_TMP_DIR = tempfile.mkdtemp(prefix="allergy-tests-")
+os.environ["ALLERGY_DB_PATH"] = os.path.join(_TMP_DIR, "test.db")
+os.environ.pop("DATABASE_URL", None)
+os.environ["OCR_MODE"] = "sync"
+os.environ["WRITE_BEHIND"] = "0"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def pytest_sessionfinish(session, exitstatus):
+    shutil.rmtree(_TMP_DIR, ignore_errors=True)
+
+
+_usernames = itertools.count()
+
+
+@pytest.fixture
+def user():
+    """A fresh user allergic to milk."""
+    import app
+    name = f"tester{next(_usernames)}"
+    conn = app.get_db_connection()
+    conn.execute("INSERT INTO users (username, password_hash, full_name, allergies, allergy_mask) VALUES (?, ?, ?, ?, ?)",
+                 (name, "-", name, '["milk"]', app.allergen_mask(["milk"])))
+    conn.commit()
+    user_id = conn.execute("SELECT id FROM users WHERE username = ?", (name,)).fetchone()[0]
+    conn.close()
+    return app.get_user_by_id(user_id)
+
+
+@pytest.fixture
+def client(user):
+    """A test client logged in as `user`."""
+    import app
+    client = app.app.test_client()
+    with client.session_transaction() as sess:
+        sess["user_id"] = user["id"]
+        sess["username"] = user["username"]
+    return client
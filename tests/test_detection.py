@@ -0,0 +1,77 @@
+# tests/test_detection.py
+import random
+
+import pytest
+
+import app
+
+
+def reference_detect(raw_text):
+    """The original per-keyword substring loop, kept as the oracle for the compiled matcher."""
+    raw_lower = raw_text.lower()
+    detected = []
+    for allergen_key, keywords in app.PREDEFINED_ALLERGENS.items():
+        for kw in keywords:
+            if kw in raw_lower:
+                detected.append({"allergen": allergen_key, "matched": kw, "severity": "high"})
+                break
+    if "may contain" in raw_lower or "produced in a facility" in raw_lower:
+        for allergen_key in app.PREDEFINED_ALLERGENS:
+            detected.append({"allergen": allergen_key, "matched": "may contain/produced in facility", "severity": "medium"})
+    if "free from" in raw_lower or "-free" in raw_lower:
+        for allergen_key, keywords in app.PREDEFINED_ALLERGENS.items():
+            for kw in keywords:
+                if f"{kw} free" in raw_lower or f"{kw}-free" in raw_lower:
+                    detected.append({"allergen": allergen_key, "matched": f"{kw}-free", "severity": "low"})
+    return detected
+
+
+def label_texts():
+    rng = random.Random(7)
+    keywords = [kw for kws in app.PREDEFINED_ALLERGENS.values() for kw in kws]
+    extras = ["water", "salt", "sugar", "may contain", "produced in a facility", "free from", "gluten-free",
+              "milk free", "Soy-Free", "E220", "PEANUTS", "wheat flour (gluten)"]
+    texts = ["", "Ingredients: water, salt.", "Contains MILK and Egg. May contain traces of nuts.",
+             "Gluten-free oats, milk free, free from sesame", "sulfur dioxide (E220), celeriac, lupine"]
+    for _ in range(200):
+        items = [rng.choice(keywords + extras) for _ in range(rng.randrange(1, 15))]
+        texts.append(", ".join(items))
+    return texts
+
+
+@pytest.mark.parametrize("text", label_texts())
+def test_exact_matcher_returns_the_original_detections(monkeypatch, text):
+    monkeypatch.setattr(app, "FUZZY_MATCHING", False)
+    detected = [{k: v for k, v in d.items() if k != "confidence"} for d in app.detect_allergens_from_text(text)]
+    assert detected == reference_detect(text)
+
+
+@pytest.mark.parametrize("text", ["water, calcium sulfate", "ferrous sulphate", "lactase enzyme", "cheat, smelt, spell"])
+def test_fuzzy_matching_ignores_real_words(text):
+    assert [d for d in app.detect_allergens_from_text(text) if "ocr_text" in d] == []
+
+
+@pytest.mark.parametrize("text, allergen", [("rnilk powder", "milk"), ("pe4nut oil", "peanut"), ("wh eat flour", "wheat")])
+def test_fuzzy_matching_repairs_ocr_noise(text, allergen):
+    hits = [d for d in app.detect_allergens_from_text(text) if d["severity"] == "high"]
+    assert [d["allergen"] for d in hits] == [allergen]
+    assert hits[0]["confidence"] < 1.0
+
+
+def _stored_ruleset(scan_id):
+    conn = app.get_db_connection()
+    version = conn.execute("SELECT ruleset_version FROM scan_history WHERE id = ?", (scan_id,)).fetchone()[0]
+    conn.close()
+    return version
+
+
+def test_scans_cut_short_by_the_fuzzy_budget_are_left_for_reevaluation(monkeypatch):
+    text = "Ingredients: rnilk powder, sugar"
+    complete = app.detect_allergens_from_text(text)
+    assert complete.complete
+    assert _stored_ruleset(app.save_scan_history("budget", "bar", text, ["milk"], complete)) == app.RULESET_VERSION
+
+    monkeypatch.setattr(app, "FUZZY_BUDGET_MS", -1)
+    cut_short = app.detect_allergens_from_text(text)
+    assert not cut_short.complete
+    assert _stored_ruleset(app.save_scan_history("budget", "bar", text, [], cut_short)) is None
@@ -0,0 +1,39 @@
+# tests/test_export.py
+import csv
+import gzip
+import io
+import json
+
+import app
+
+
+def _fill(user):
+    for i in range(5):
+        text = f"scan {i}: sugar, milk"
+        app.save_scan_history(user["username"], f"bar {i}", text, ["milk"], app.detect_allergens_from_text(text))
+    app.add_feedback(user["username"], "bar 0", "mild", "itchy")
+
+
+def test_ndjson_export_streams_every_record(user):
+    _fill(user)
+    chunks = list(app.export_user_data(user["username"], "all", "ndjson", chunk_bytes=200))
+    assert len(chunks) > 1
+    records = [json.loads(line) for line in b"".join(chunks).decode().splitlines()]
+    history = [r for r in records if r["type"] == "history"]
+    assert [r["product_name"] for r in history] == [f"bar {i}" for i in reversed(range(5))]
+    assert history[0]["ingredients"] == "scan 4: sugar, milk"
+    assert [d["allergen"] for d in history[0]["detections"]] == ["milk"]
+    assert [(r["type"], r["notes"]) for r in records if r["type"] == "feedback"] == [("feedback", "itchy")]
+
+
+def test_gzipped_csv_download(client, user):
+    _fill(user)
+    res = client.get("/export?kind=history&format=csv&gzip=1")
+    assert res.status_code == 200 and res.mimetype == "application/gzip"
+    rows = list(csv.DictReader(io.StringIO(gzip.decompress(res.get_data()).decode())))
+    assert len(rows) == 5 and {r["type"] for r in rows} == {"history"}
+    assert json.loads(rows[0]["detected_allergens"]) == ["milk"]
+
+
+def test_unknown_export_kind_is_rejected(client):
+    assert client.get("/export?kind=passwords").status_code == 400
@@ -0,0 +1,45 @@
+# tests/test_http_caching.py
+import gzip
+import os
+
+import app
+
+BARCODE = "8901234567890"  # seeded demo product
+
+
+def test_json_is_gzipped_for_clients_that_accept_it(client, monkeypatch):
+    monkeypatch.setattr(app, "COMPRESS_MIN_SIZE", 0)
+    plain = client.get(f"/scan_barcode?barcode={BARCODE}")
+    res = client.get(f"/scan_barcode?barcode={BARCODE}", headers={"Accept-Encoding": "gzip"})
+    assert "Content-Encoding" not in plain.headers
+    assert res.headers["Content-Encoding"] == "gzip"
+    assert "Accept-Encoding" in res.headers["Vary"]
+    assert gzip.decompress(res.get_data()) == plain.get_data()
+
+
+def test_unchanged_product_revalidates_with_304(client):
+    first = client.get(f"/scan_barcode?barcode={BARCODE}")
+    etag = first.headers["ETag"]
+    assert etag.startswith("W/")
+    again = client.get(f"/scan_barcode?barcode={BARCODE}", headers={"If-None-Match": etag})
+    assert again.status_code == 304 and again.get_data() == b""
+
+
+def test_versioned_static_assets_are_immutable_and_compressed(client):
+    with app.app.test_request_context():
+        url = app.asset_url("scan.js")
+    res = client.get(url, headers={"Accept-Encoding": "gzip"})
+    assert res.cache_control.immutable and res.cache_control.max_age == app.STATIC_MAX_AGE
+    with open(os.path.join(app.app.static_folder, "scan.js"), "rb") as f:
+        assert gzip.decompress(res.get_data()) == f.read()
+    stale = client.get(url.split("?")[0] + "?v=outdated")
+    assert stale.cache_control.no_cache and not stale.cache_control.immutable
+    stale.close()
+    res.close()
+
+
+def test_streamed_responses_are_not_compressed(client, monkeypatch):
+    monkeypatch.setattr(app, "COMPRESS_MIN_SIZE", 0)
+    res = client.post("/scan_batch", json={"texts": ["milk"]}, headers={"Accept-Encoding": "gzip"})
+    assert "Content-Encoding" not in res.headers
+    assert b'"milk"' in res.get_data()
@@ -0,0 +1,35 @@
+# tests/test_listing_indexes.py
+from datetime import datetime
+
+import app
+
+
+def test_fresh_schema_is_current():
+    assert app.init_db() == len(app.MIGRATIONS)
+
+
+def test_listing_queries_use_indexes():
+    # {} means no listing query scans a table or sorts instead of using its index
+    assert app.check_listing_indexes() == {}
+
+
+def test_keyset_pages_do_not_overlap():
+    for i in range(5):
+        app.add_feedback("pager", f"product {i}", "none", "")
+    first = app.get_feedback_by_user("pager", limit=3)
+    second = app.get_feedback_by_user("pager", limit=3, before=app.decode_cursor(app.next_cursor(first, 3)))
+    assert len(first) == 3 and len(second) == 2
+    assert not {r["id"] for r in first} & {r["id"] for r in second}
+
+
+def test_cursor_round_trips_datetime_timestamps():
+    # PostgreSQL rows carry datetimes rather than SQLite's text timestamps
+    stamp = datetime(2026, 3, 1, 12, 30, 5, 250000)
+    cursor = app.encode_cursor({"timestamp": stamp, "id": 7})
+    assert app.decode_cursor(cursor) == ("2026-03-01 12:30:05.250000", 7)
+    assert app.decode_cursor(app.encode_cursor({"timestamp": "2026-03-01 12:30:05", "id": 7})) == ("2026-03-01 12:30:05", 7)
+
+
+def test_garbled_cursor_is_ignored():
+    assert app.decode_cursor(app.encode_cursor({"timestamp": "yesterday", "id": 1})) is None
+    assert app.decode_cursor("not base64!") is None
@@ -0,0 +1,79 @@
+# tests/test_migrations.py
+import sqlite3
+
+import pytest
+
+import app
+
+# Tables as they were before the migrations existed
+LEGACY_SCHEMA = """
+CREATE TABLE users (id INTEGER PRIMARY KEY AUTOINCREMENT, username TEXT UNIQUE NOT NULL,
+                    password_hash TEXT NOT NULL, full_name TEXT, allergies TEXT DEFAULT '[]');
+CREATE TABLE feedback (id INTEGER PRIMARY KEY AUTOINCREMENT, username TEXT, product_name TEXT,
+                       reaction TEXT, notes TEXT, timestamp DATETIME DEFAULT CURRENT_TIMESTAMP);
+CREATE TABLE scan_history (id INTEGER PRIMARY KEY AUTOINCREMENT, username TEXT, product_name TEXT,
+                           ingredients TEXT, detected_allergens TEXT, timestamp DATETIME DEFAULT CURRENT_TIMESTAMP);
+"""
+
+
+@pytest.fixture
+def legacy_db(tmp_path, monkeypatch):
+    """Point app at a pre-migration database holding a few old rows."""
+    path = str(tmp_path / "legacy.db")
+    raw = sqlite3.connect(path)
+    raw.executescript(LEGACY_SCHEMA)
+    raw.executemany("INSERT INTO users (username, password_hash, allergies) VALUES (?, '-', ?)",
+                    [("ann", '["milk"]'), ("bob", '["peanut", "egg"]'), ("cat", "[]")])
+    raw.executemany("INSERT INTO scan_history (username, product_name, ingredients, detected_allergens) VALUES (?, ?, ?, ?)",
+                    [("ann", "bar", "sugar, milk powder", "milk")] * 3 + [("bob", "nuts", "roasted peanuts", "peanut")])
+    raw.executemany("INSERT INTO feedback (username, product_name, reaction) VALUES (?, ?, ?)",
+                    [("ann", "bar", "mild"), ("bob", "bar", "mild"), ("bob", "bar", "severe")])
+    raw.commit()
+    raw.close()
+    saved = getattr(app._db_local, "conn", None)
+    monkeypatch.setattr(app, "DB_PATH", path)
+    app._db_local.conn = None
+    yield path
+    app._db_local.conn.close_for_real()
+    app._db_local.conn = saved
+
+
+def _query(sql, params=()):
+    conn = app.get_db_connection()
+    rows = [tuple(r) for r in conn.execute(sql, params).fetchall()]
+    conn.close()
+    return rows
+
+
+def test_migrations_leave_old_rows_to_the_backfill(legacy_db):
+    assert app.init_db() == len(app.MIGRATIONS)
+    conn = app.get_db_connection()
+    assert app.pending_backfills(conn) == sorted(app.BACKFILLS)
+    conn.close()
+    assert _query("SELECT COUNT(*) FROM scan_history WHERE ingredients_hash IS NULL") == [(4,)]
+    # old scans still read back correctly before the backfill has run
+    (scan,) = app.get_scan_history_by_user("bob")
+    assert scan["ingredients"] == "roasted peanuts"
+    assert [d["allergen"] for d in scan["detections"]] == ["peanut"]
+
+
+def test_backfill_resumes_without_double_counting(legacy_db):
+    app.init_db()
+
+    def stop_after_first_batch(name, done):
+        if name == "feedback_counts":
+            raise KeyboardInterrupt
+
+    with pytest.raises(KeyboardInterrupt):
+        app.run_backfills(batch_size=2, progress=stop_after_first_batch)
+    app.run_backfills(batch_size=2)
+
+    conn = app.get_db_connection()
+    assert app.pending_backfills(conn) == []
+    conn.close()
+    assert _query("SELECT COUNT(*) FROM scan_history WHERE ingredients_hash IS NULL") == [(0,)]
+    assert _query("SELECT COUNT(DISTINCT scan_id) FROM scan_detections") == [(4,)]
+    assert _query("SELECT cnt FROM feedback_product_counts WHERE product_name = 'bar'") == [(3,)]
+    assert _query("SELECT reaction, cnt FROM feedback_reaction_counts ORDER BY reaction") == [("mild", 2), ("severe", 1)]
+    masks = dict(_query("SELECT username, allergy_mask FROM users"))
+    assert masks == {"ann": app.allergen_mask(["milk"]), "bob": app.allergen_mask(["peanut", "egg"]), "cat": 0}
@@ -0,0 +1,52 @@
+# tests/test_ocr_cache.py
+import io
+import random
+
+from PIL import Image, ImageDraw
+
+import app
+
+
+def _label(size=(340, 240), text="Contains: milk, wheat", fmt="PNG"):
+    # Coarse, high-contrast blocks so a JPEG round trip keeps every hash bit
+    rng = random.Random(5)
+    cells = Image.new("L", (17, 16))
+    cells.putdata([v for _ in range(16) for v in rng.sample(range(0, 256, 12), 17)])
+    image = cells.resize(size, Image.NEAREST).convert("RGB")
+    ImageDraw.Draw(image).text((10, 10), text, fill="black")
+    buf = io.BytesIO()
+    image.save(buf, fmt, **({"quality": 95} if fmt == "JPEG" else {}))
+    return buf.getvalue()
+
+
+def test_text_survives_the_memory_tier():
+    app.ocr_cache_put("key-disk", "sugar, milk")
+    app._ocr_memory_cache.clear()
+    hits = app.ocr_cache_stats["disk_hits"]
+    assert app.ocr_cache_get("key-disk") == "sugar, milk"
+    assert app.ocr_cache_stats["disk_hits"] == hits + 1
+    assert app.ocr_cache_get("key-unknown") is None
+
+
+def test_phash_only_matches_the_same_dimensions():
+    text = "Ingredients: peanuts"
+    app.ocr_cache_put("key-photo", text, app.image_phash(_label()))
+    recompressed = app.image_phash(_label(fmt="JPEG"))
+    resized = app.image_phash(_label(size=(680, 480)))
+    assert app.ocr_cache_get("key-recompressed", recompressed) == text
+    assert app.ocr_cache_get("key-resized", resized) is None
+
+
+def test_least_recently_used_entries_are_evicted(monkeypatch):
+    monkeypatch.setattr(app, "OCR_CACHE_MAX_BYTES", 0)
+    app.ocr_cache_put("key-evicted", "x" * 100)
+    app._ocr_memory_cache.clear()
+    assert app.ocr_cache_get("key-evicted") is None
+
+
+def test_cached_upload_skips_ocr(client):
+    data = _label(text="cached label")
+    app.ocr_cache_put(app.ocr_cache_key(data), "Ingredients: whole milk")
+    res = client.post("/scan", data={"image": (io.BytesIO(data), "label.png")})
+    assert res.status_code == 200
+    assert [d["allergen"] for d in res.get_json()["detections"]] == ["milk"]
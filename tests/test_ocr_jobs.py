@@ -0,0 +1,52 @@
+# tests/test_ocr_jobs.py
+import time
+from concurrent.futures import Future
+
+import app
+
+
+def _pending_job(user, deadline_in=60):
+    job_id = f"job-{time.monotonic_ns()}"
+    now = time.time()
+    conn = app.get_db_connection()
+    conn.execute("INSERT INTO ocr_jobs (id, user_id, status, created, deadline) VALUES (?, ?, 'pending', ?, ?)",
+                 (job_id, user["id"], now, now + deadline_in))
+    conn.commit()
+    conn.close()
+    return job_id
+
+
+def _ocr_done(text):
+    future = Future()
+    future.set_result((text, {}))
+    return future
+
+
+def test_finished_job_is_stored_and_saved_to_history(user):
+    job_id = _pending_job(user)
+    app._finish_ocr_job(job_id, user["id"], _ocr_done("Ingredients: sugar, milk solids"))
+    job = app.get_ocr_job(job_id)
+    assert job["status"] == "done"
+    history = app.get_scan_history_by_user(user["username"])
+    assert [h["detected_allergens"] for h in history] == ["milk"]
+
+
+def test_timed_out_job_stays_failed_and_is_not_saved(user):
+    job_id = _pending_job(user, deadline_in=-10)
+    assert app.get_ocr_job(job_id)["error"] == "OCR timed out"
+    app._finish_ocr_job(job_id, user["id"], _ocr_done("milk"))
+    assert app.get_ocr_job(job_id)["status"] == "failed"
+    assert app.get_scan_history_by_user(user["username"]) == []
+
+
+def test_status_poll_answers_without_waiting(client, user):
+    job_id = _pending_job(user)
+    started = time.monotonic()
+    res = client.get(f"/scan/jobs/{job_id}?wait=10")
+    assert res.status_code == 202 and res.get_json()["status"] == "pending"
+    assert time.monotonic() - started < 1
+
+
+def test_jobs_are_private(client, user):
+    other = dict(user, id=user["id"] + 10_000)
+    assert client.get(f"/scan/jobs/{_pending_job(other)}").status_code == 404
@@ -0,0 +1,27 @@
+# tests/test_products.py
+import app
+
+
+def _put_product(barcode, ingredients, detections=None, ruleset_version=None):
+    conn = app.get_db_connection()
+    conn.execute("INSERT OR REPLACE INTO products (barcode, name, ingredients, detections, ruleset_version) "
+                 "VALUES (?, ?, ?, ?, ?)", (barcode, "Test product", ingredients, detections, ruleset_version))
+    conn.commit()
+    conn.close()
+
+
+def test_analysis_from_an_older_ruleset_is_redone():
+    _put_product("1000000000001", "Sugar, skimmed milk powder", detections="[]", ruleset_version="outdated")
+    app._product_cache.clear()
+    product = app.get_product_by_barcode("1000000000001")
+    assert [d["allergen"] for d in product["detections"]] == ["milk"]
+    conn = app.get_db_connection()
+    stored = conn.execute("SELECT ruleset_version FROM products WHERE barcode = ?", ("1000000000001",)).fetchone()[0]
+    conn.close()
+    assert stored == app.RULESET_VERSION
+
+
+def test_unknown_barcode_is_not_cached():
+    assert app.get_product_by_barcode("1000000000002") is None
+    _put_product("1000000000002", "Water")
+    assert app.get_product_by_barcode("1000000000002")["name"] == "Test product"
@@ -0,0 +1,35 @@
+# tests/test_scan_batch.py
+import json
+
+import app
+
+
+def _history_count(user):
+    return len(app.get_scan_history_by_user(user["username"]))
+
+
+def test_batch_streams_one_result_per_item(client, user):
+    res = client.post("/scan_batch", json={"texts": ["milk chocolate", "plain water"], "barcodes": ["0000000000000"]})
+    lines = [json.loads(line) for line in res.get_data(as_text=True).splitlines()]
+    assert [(r["type"], r["index"]) for r in lines] == [("text", 0), ("text", 1), ("barcode", 0)]
+    assert [d["allergen"] for d in lines[0]["detections"]] == ["milk"]
+    assert "error" in lines[2]
+    assert _history_count(user) == 2
+
+
+def test_batch_history_is_saved_while_streaming(client, user, monkeypatch):
+    monkeypatch.setattr(app, "SCAN_BATCH_SAVE_EVERY", 3)
+    res = client.post("/scan_batch", json={"texts": [f"sugar, milk {i}" for i in range(8)]}, buffered=False)
+    stream = iter(res.response)
+    for _ in range(4):
+        next(stream)
+    # the first chunk is committed before the rest of the batch has been produced
+    assert _history_count(user) == 3
+    # a client that goes away still keeps everything it was sent
+    res.close()
+    assert _history_count(user) == 4
+
+
+def test_batch_rejects_malformed_input(client):
+    assert client.post("/scan_batch", json={"texts": "milk"}).status_code == 400
+    assert client.post("/scan_batch", json=["milk"]).status_code == 400
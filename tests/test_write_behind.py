@@ -0,0 +1,28 @@
+# tests/test_write_behind.py
+import app
+
+
+def _count(sql, params=()):
+    conn = app.get_db_connection()
+    n = conn.execute(sql, params).fetchone()[0]
+    conn.close()
+    return n
+
+
+def test_queued_writes_are_committed_in_the_background(monkeypatch):
+    monkeypatch.setattr(app, "WRITE_BEHIND", True)
+    assert app.save_scan_history("queued", "bar", "milk", ["milk"], app.detect_allergens_from_text("milk")) is None
+    app.add_feedback("queued", "bar", "mild", "")
+    assert app.flush_write_behind(timeout=5)
+    assert _count("SELECT COUNT(*) FROM scan_history WHERE username = ?", ("queued",)) == 1
+    assert _count("SELECT COUNT(*) FROM scan_detections WHERE username = ?", ("queued",)) == 1
+    assert _count("SELECT COUNT(*) FROM feedback WHERE username = ?", ("queued",)) == 1
+
+
+def test_a_bad_item_does_not_sink_its_batch():
+    failed = app.write_behind_stats["failed"]
+    good = ("batchmate", "bar", "none", "", app._utc_timestamp())
+    bad = ("batchmate",)  # too few columns for an insert
+    app._flush_write_batch([("feedback", [good]), ("scan_history", [bad])])
+    assert app.write_behind_stats["failed"] == failed + 1
+    assert _count("SELECT COUNT(*) FROM feedback WHERE username = ?", ("batchmate",)) == 1